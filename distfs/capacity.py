@@ -0,0 +1,377 @@
+#
+
+from twisted.internet import defer
+from twisted.python import log
+from distfs import idistfs
+from zope.interface import implements
+from collections import OrderedDict
+
+import itertools
+import sqlite3
+import heapq
+import time
+import os
+
+"""Keeping a chunk store within a quota by evicting chunks.
+"""
+
+
+class LRUPolicy(object):
+    """
+    Evicts the chunk that was least recently used.
+    """
+
+    def __init__(self):
+        self.order = OrderedDict()
+
+    def add(self, chunkName, hits=0):
+        self.order.pop(chunkName, None)
+        self.order[chunkName] = True
+
+    def touch(self, chunkName):
+        if self.order.pop(chunkName, None) is not None:
+            self.order[chunkName] = True
+
+    def remove(self, chunkName):
+        self.order.pop(chunkName, None)
+
+    def hits(self, chunkName):
+        return 0
+
+    def victims(self):
+        """
+        Iterate through the chunks from the first to the last to be
+        evicted.  The policy must not be changed during the
+        iteration.
+        """
+        return iter(self.order)
+
+
+class LFUPolicy(object):
+    """
+    Evicts the chunk that was used the least number of times, the
+    least recently used first among equals.
+
+    The chunks are kept in a heap; entries that are out of date are
+    skipped rather than removed from it, and the heap is rebuilt when
+    they make up most of it.  Only the last entry pushed for a chunk,
+    as recorded in C{latest}, is valid.
+    """
+
+    def __init__(self):
+        self.counts = dict()
+        self.latest = dict()
+        self.heap = list()
+        self.counter = itertools.count()
+
+    def _push(self, chunkName):
+        if len(self.heap) > 2 * len(self.counts) + 64:
+            self.heap = list()
+            for name in self.counts:
+                counter = self.latest[name] = self.counter.next()
+                self.heap.append((self.counts[name], counter, name))
+            heapq.heapify(self.heap)
+            return
+        counter = self.latest[chunkName] = self.counter.next()
+        heapq.heappush(self.heap, (self.counts[chunkName], counter,
+                                   chunkName))
+
+    def add(self, chunkName, hits=0):
+        """
+        Add a chunk, or count a chunk that is added again as recently
+        used without losing its hits.
+        """
+        self.counts[chunkName] = self.counts.get(chunkName, hits)
+        self._push(chunkName)
+
+    def touch(self, chunkName):
+        if chunkName in self.counts:
+            self.counts[chunkName] += 1
+            self._push(chunkName)
+
+    def remove(self, chunkName):
+        self.counts.pop(chunkName, None)
+        self.latest.pop(chunkName, None)
+
+    def hits(self, chunkName):
+        return self.counts.get(chunkName, 0)
+
+    def victims(self):
+        """
+        Iterate through the chunks from the first to the last to be
+        evicted.  The policy must not be changed during the
+        iteration.
+        """
+        popped = list()
+        try:
+            while self.heap:
+                entry = heapq.heappop(self.heap)
+                hits, counter, chunkName = entry
+                if self.latest.get(chunkName) != counter:
+                    continue
+                popped.append(entry)
+                yield chunkName
+        finally:
+            for entry in popped:
+                heapq.heappush(self.heap, entry)
+
+
+evictionPolicies = {'lru': LRUPolicy, 'lfu': LFUPolicy}
+
+
+def parseSize(value):
+    """
+    Parse a size in bytes, optionally with a C{K}, C{M}, C{G} or C{T}
+    suffix.
+
+    @raise ValueError: if C{value} is not a size.
+    """
+    value = value.strip().upper()
+    multiplier = 1
+    if value and value[-1] in 'KMGT':
+        multiplier = 1024 ** ('KMGT'.index(value[-1]) + 1)
+        value = value[:-1]
+    return int(value) * multiplier
+
+
+class _BoundedStoreFile(object):
+    """
+    Store file that tells the L{BoundedStore} about the chunk when it
+    has been committed.
+    """
+
+    def __init__(self, store, chunkName, storeFile):
+        self.store = store
+        self.chunkName = chunkName
+        self.storeFile = storeFile
+
+    def __getattr__(self, name):
+        return getattr(self.storeFile, name)
+
+    def close(self):
+        closeDeferred = defer.maybeDeferred(self.storeFile.close)
+        return closeDeferred.addCallback(self.store.added, self.chunkName,
+                                         False)
+
+
+class BoundedStore(object):
+    """
+    Store that keeps another store within a byte and chunk quota, so
+    that a node can act as a bounded cache.
+
+    When a new chunk takes the store beyond its quota, chunks are
+    evicted in the order given by the eviction policy, which learns
+    how chunks are used from L{query}.  Chunks that have been pinned,
+    and chunks that this node is the origin of because they were
+    pumped into the store with C{origin} set, are never evicted.
+    Chunks that other nodes upload or that are downloaded can be.
+
+    Pins, origins and access statistics are kept in C{capacity.db} in
+    the directory of the store.  Access statistics are written by
+    L{flush}.
+
+    @ivar backend: the store that holds the chunks.
+    @ivar maxBytes: byte quota, or C{None} for no limit.
+    @ivar maxChunks: chunk quota, or C{None} for no limit.
+    @ivar policy: the eviction policy.
+    @ivar sizes: a C{dict} that maps chunk names to their sizes.
+    @ivar atimes: a C{dict} that maps chunk names to when they were
+        last used.
+    @ivar usedBytes: number of bytes in the store.
+    @ivar pinned: names of the pinned chunks.
+    @ivar origin: names of the chunks this node is the origin of.
+    """
+    implements(idistfs.IStore)
+
+    def __init__(self, backend, maxBytes=None, maxChunks=None,
+                 policy='lru', clock=time.time):
+        self.backend = backend
+        self.maxBytes = maxBytes
+        self.maxChunks = maxChunks
+        self.policy = evictionPolicies[policy]()
+        self.clock = clock
+        self.pinned = set()
+        self.origin = set()
+        self.dirty = dict()
+
+        dbFile = backend.dir.child('capacity.db').path
+        createDB = not os.path.exists(dbFile)
+        self._db = sqlite3.connect(dbFile)
+        self._db.isolation_level = None
+        self._db.text_factory = str
+        if createDB:
+            self._db.execute('CREATE TABLE chunks(name PRIMARY KEY, pinned, '
+                             'origin, atime, hits)')
+        stats = dict()
+        for name, pinned, origin, atime, hits in self._db.execute(
+            'SELECT name, pinned, origin, atime, hits FROM chunks'):
+            if pinned:
+                self.pinned.add(name)
+            if origin:
+                self.origin.add(name)
+            stats[name] = (atime or 0, hits or 0)
+
+        self.sizes = dict()
+        self.atimes = dict()
+        self.usedBytes = 0
+        chunks = list()
+        for chunkName in backend.iterChunks():
+            size = backend.query(chunkName)[1]
+            self.sizes[chunkName] = size
+            self.usedBytes += size
+            atime, hits = stats.get(chunkName, (0, 0))
+            self.atimes[chunkName] = atime
+            chunks.append((atime, chunkName, hits))
+        for atime, chunkName, hits in sorted(chunks):
+            self.policy.add(chunkName, hits)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _update(self, chunkName):
+        self.dirty[chunkName] = True
+
+    def flush(self):
+        """
+        Write pins, origins and access statistics to the database.
+        """
+        self._db.execute('BEGIN')
+        for chunkName in self.dirty:
+            if chunkName not in self.sizes and chunkName not in self.pinned:
+                self._db.execute('DELETE FROM chunks WHERE name=?',
+                                 (chunkName,))
+                continue
+            self._db.execute('INSERT OR REPLACE INTO chunks(name, pinned, '
+                             'origin, atime, hits) VALUES (?, ?, ?, ?, ?)',
+                             (chunkName, chunkName in self.pinned,
+                              chunkName in self.origin,
+                              self.atimes.get(chunkName, 0),
+                              self.policy.hits(chunkName)))
+        self._db.execute('COMMIT')
+        self.dirty = dict()
+
+    def pressure(self):
+        """
+        Return how full the store is, as a fraction of the quota.
+        """
+        fractions = [0.0]
+        if self.maxBytes:
+            fractions.append(float(self.usedBytes) / self.maxBytes)
+        if self.maxChunks:
+            fractions.append(float(len(self.sizes)) / self.maxChunks)
+        return max(fractions)
+
+    def pin(self, chunkName):
+        """
+        Protect the specified chunk from eviction.  Chunks can be
+        pinned before they are in the store.
+        """
+        self.pinned.add(chunkName)
+        self._update(chunkName)
+
+    def unpin(self, chunkName):
+        self.pinned.discard(chunkName)
+        self._update(chunkName)
+
+    def isProtected(self, chunkName):
+        return chunkName in self.pinned or chunkName in self.origin
+
+    def added(self, result, chunkName, origin):
+        """
+        Account a chunk that has been committed to the store and evict
+        chunks if the quota has been exceeded.
+        """
+        if not self.backend.hasChunk(chunkName):
+            return result
+        if chunkName in self.sizes:
+            self.usedBytes -= self.sizes[chunkName]
+        size = self.backend.query(chunkName)[1]
+        self.sizes[chunkName] = size
+        self.usedBytes += size
+        self.atimes[chunkName] = self.clock()
+        self.policy.add(chunkName)
+        if origin:
+            self.origin.add(chunkName)
+        self._update(chunkName)
+        self.evict(chunkName)
+        return result
+
+    def _overQuota(self, usedBytes, chunks):
+        if self.maxBytes is not None and usedBytes > self.maxBytes:
+            return True
+        if self.maxChunks is not None and chunks > self.maxChunks:
+            return True
+        return False
+
+    def evict(self, keep=None):
+        """
+        Evict chunks until the store is within its quota.
+
+        @param keep: name of a chunk that must not be evicted, such as
+            the one that was just added.
+        @return: the number of evicted chunks.
+        """
+        usedBytes, chunks = self.usedBytes, len(self.sizes)
+        if not self._overQuota(usedBytes, chunks):
+            return 0
+        victims = list()
+        for chunkName in self.policy.victims():
+            if self.isProtected(chunkName) or chunkName == keep:
+                continue
+            victims.append(chunkName)
+            usedBytes -= self.sizes[chunkName]
+            chunks -= 1
+            if not self._overQuota(usedBytes, chunks):
+                break
+        else:
+            log.msg("store is over its quota but has nothing to evict")
+        for chunkName in victims:
+            self.remove(chunkName)
+        return len(victims)
+
+    def hasChunk(self, chunkName):
+        return self.backend.hasChunk(chunkName)
+
+    def __contains__(self, chunkName):
+        return self.backend.hasChunk(chunkName)
+
+    def iterChunks(self):
+        return self.backend.iterChunks()
+
+    def query(self, chunkName):
+        """
+        Query the store for the specified chunk and count it as used.
+        """
+        result = self.backend.query(chunkName)
+        self.atimes[chunkName] = self.clock()
+        self.policy.touch(chunkName)
+        self._update(chunkName)
+        return result
+
+    def locate(self, chunkName):
+        return self.backend.locate(chunkName)
+
+    def pump(self, chunkName, fromFile, origin=False):
+        """
+        Put a chunk in the store.
+
+        @param origin: C{True} if this node is the origin of the chunk,
+            which protects it from eviction.
+        """
+        pumpDeferred = self.backend.pump(chunkName, fromFile)
+        return pumpDeferred.addCallback(self.added, chunkName, origin)
+
+    def store(self, chunkName, resume=False):
+        """
+        Return a file for a chunk that is fetched from another node.
+        """
+        return _BoundedStoreFile(self, chunkName,
+                                 self.backend.store(chunkName, resume))
+
+    def remove(self, chunkName):
+        self.backend.remove(chunkName)
+        self.usedBytes -= self.sizes.pop(chunkName, 0)
+        self.atimes.pop(chunkName, None)
+        self.policy.remove(chunkName)
+        self.origin.discard(chunkName)
+        self._update(chunkName)
@@ -1,8 +1,10 @@
 from twisted.protocols import amp
-from twisted.web.client import downloadPage
 from twisted.internet.protocol import Factory
 from twisted.internet import defer
-import random
+from twisted.python import log
+from distfs.download import Downloader
+from distfs.readahead import ReadAhead
+from distfs.util import FOREGROUND, BACKGROUND
 
 
 class ResolveError(Exception):
@@ -19,7 +21,16 @@ class Notify(amp.Command):
     successfully downloaded and is available in the local store.
     """
     arguments = [('chunkName', amp.String())]
-    
+
+
+class Unavailable(amp.Command):
+    """
+    Notification that a chunk of a streaming retrieve (see
+    L{Retrieve}) could not be resolved or downloaded.
+    """
+    arguments = [('chunkName', amp.String())]
+    requiresAnswer = False
+
 
 class Retrieve(amp.Command):
     """
@@ -27,22 +38,59 @@ class Retrieve(amp.Command):
     
     The agent will response as soon as it has resolved locations for
     all chunks, and the chunks has been put on the download queue.
-
-    The agent MAY send notifcations (see L{Notify}) for chunks before
-    answering the request, but then it MUST have resolved all chunks
-    first.
+    Each chunk is put on the queue as soon as it has been resolved,
+    so the agent MAY send notifications (see L{Notify}) for chunks
+    before answering the request.
 
     The C{background} flag specifies if the chunks should be retreived
     in the background.  The agent will not generate any notifications
-    then.  This can be used for pre-fetching chunks.
-
-    If a chunk could not be resolved an error is raised.
+    then.  This can be used for pre-fetching chunks.  Background
+    downloads only proceed when no foreground downloads are waiting.
+
+    If a chunk could not be resolved an error is raised; the chunks
+    that were resolved are downloaded anyway.
+
+    If the C{stream} flag is set the agent answers at once, without
+    waiting for the chunks to be resolved, and sends an
+    L{Unavailable} notification instead of a L{Notify} for each
+    foreground chunk that could not be resolved or downloaded.
+
+    Foreground chunks of files that the client has told about with
+    L{OpenFile} are also used to detect sequential reads, which the
+    agent reads ahead of in the background.
+
+    Within a priority class the chunks of a client are downloaded in
+    the order of their C{order} hints, so that a client that reads
+    sequentially can get the earliest chunks first even when they are
+    resolved last.  Chunks without a hint are numbered in the order
+    the agent receives them, counting across all requests of the
+    connection, and that number is used as their hint.
     """
-    arguments = [('chunks', amp.AmpList([('chunkName', amp.String)])),
-                 ('background', amp.Integer())]
+    arguments = [('chunks', amp.AmpList([('chunkName', amp.String()),
+                                         ('order', amp.Integer(optional=True))
+                                         ])),
+                 ('background', amp.Integer()),
+                 ('stream', amp.Integer(optional=True))]
     errors = {ResolveError: 'RESOLVE_ERROR'}
 
 
+class OpenFile(amp.Command):
+    """
+    Tell the agent the chunk list of a file that the client is about
+    to read, so that the agent can read ahead when the client
+    retrieves the chunks of the file in sequence.
+    """
+    arguments = [('fileName', amp.String()),
+                 ('chunks', amp.AmpList([('chunkName', amp.String())]))]
+
+
+class CloseFile(amp.Command):
+    """
+    Tell the agent that the client has stopped reading a file.
+    """
+    arguments = [('fileName', amp.String())]
+
+
 class Replicate(amp.Command):
     """
     Tell the agent to replicate the specified chunks.
@@ -50,10 +98,36 @@ class Replicate(amp.Command):
     @param depth: replication depth, higher value means better
         availability but also increases preasure on upload.
     """
-    arguments = [('chunks', amp.AmpList([('chunkName', amp.String)])),
+    arguments = [('chunks', amp.AmpList([('chunkName', amp.String())])),
                  ('depth', amp.Integer())]
 
 
+class PeerStatistics(amp.Command):
+    """
+    Ask the agent for its statistics about the peers it has fetched
+    chunks from.
+
+    C{rtt} is in seconds and C{bandwidth} in bytes per second; both
+    are zero for peers that have not been measured yet.  C{failures}
+    is the number of recent failures, decayed over time.
+    """
+    response = [('peers', amp.AmpList([('address', amp.String()),
+                                       ('port', amp.Integer()),
+                                       ('rtt', amp.Float()),
+                                       ('bandwidth', amp.Float()),
+                                       ('failures', amp.Float()),
+                                       ('transfers', amp.Integer())]))]
+
+
+class Pin(amp.Command):
+    """
+    Tell the agent to protect the specified chunks from being evicted
+    from its store, or to stop protecting them if C{pinned} is zero.
+    """
+    arguments = [('chunks', amp.AmpList([('chunkName', amp.String())])),
+                 ('pinned', amp.Integer())]
+
+
 class Shutdown(amp.Command):
     """
     Tell the agent to disconnect from the location.
@@ -63,22 +137,34 @@ class Shutdown(amp.Command):
 class ControlClientProtocol(amp.AMP):
 
     def notify(self, chunkName):
-        pass
+        return {}
     Notify.responder(notify)
 
+    def unavailable(self, chunkName):
+        return {}
+    Unavailable.responder(unavailable)
+
 
 class ControlServerProtocol(amp.AMP):
 
-    def __init__(self, resolver, directoryServer, reactor):
+    def __init__(self, resolver, downloader, reactor, maxReadAhead=None):
         self.resolver = resolver
+        self.downloader = downloader
+        self.readAhead = ReadAhead(downloader.store, self.prefetch,
+                                   maxReadAhead)
         self.pending = list()
         self.reactor = reactor
+        self.sequence = 0
+        self.disconnected = False
 
     def connectionLost(self, reason):
         """
         Connection was lost to client for reasons specified by
         C{reason}.
         """
+        amp.AMP.connectionLost(self, reason)
+        self.disconnected = True
+        self.readAhead.clear()
         # iterate all non-background downloads and cancel them
         for queueHandle in self.pending:
             queueHandle.cancel()
@@ -91,59 +177,180 @@ class ControlServerProtocol(amp.AMP):
         @param queueHandle: queue handle from the downloader
         """
         self.pending.remove(queueHandle)
-        self.callRemote(Notify, queueHandle.chunkName)
+        self.callRemote(Notify, chunkName=queueHandle.chunkName)
 
-    def errorNotification(self, queueHandle):
+    def errorNotification(self, reason, queueHandle, stream):
         """
         Send notification to client that a chunk could not be
-        downloaded.
+        downloaded, if it asked for a streaming retrieve.
 
         @param queueHandle: queue handle from the downloader
         """
         self.pending.remove(queueHandle)
-        #self.callRemote(Notify, queueHandle.chunkName)
+        if stream:
+            self.callRemote(Unavailable, chunkName=queueHandle.chunkName)
 
-    def cbResolve(self, results, names, background):
+    def cbResolve(self, locations, chunkName, background, order, stream):
         """
-        Callback for result from the resolver.
+        Callback for result from the resolver; queue the chunk.
+
+        Background retrieves are queued behind all foreground
+        retrieves; see L{ParallelQueue}.
         """
-        for ((success, locations), name) in zip(results, names):
-            if not locations:
-                # Send notification in the next run of the event loop.
-                # This simplifies the logic a bit.
-                self.reactor.callLater(0, self.sendNotification, name)
-                continue
+        locations = list(locations)
+        if not locations:
+            raise ResolveError(chunkName)
+        self.queueChunk(chunkName, locations, background, order, stream)
 
-            queueHandle = self.downloader.add(chunkName, locations)
-            if not background:
-                doneDeferred = queueHandle.whenDone()
-                doneDeferred.addCallback(self.sendNotification)
-                doneDeferred.addErrback(self.errorNotification)
+    def ebStream(self, reason, chunkName, background):
+        """
+        Tell the client of a streaming retrieve that a chunk could not
+        be resolved.
+        """
+        if not reason.check(ResolveError):
+            log.err(reason, "could not resolve %s" % chunkName)
+        if not background and not self.disconnected:
+            self.callRemote(Unavailable, chunkName=chunkName)
 
-                # Put the handle in a list so that notications can be
-                # canceled if this connection is lost.
-                self.pending.append(queueHandle)
-        return {}
+    def queueChunk(self, chunkName, locations, background, order=0,
+                   stream=False):
+        """
+        Put a chunk on the download queue and arrange for the client
+        to be notified when it is available.
+        """
+        if self.disconnected and not background:
+            # Nobody is waiting for the chunk any more.
+            return None
+        priority = background and BACKGROUND or FOREGROUND
+        queueHandle = self.downloader.add(chunkName, locations, priority,
+                                          self, order)
+        if not background:
+            # Put the handle in a list so that notications can be
+            # canceled if this connection is lost.
+            self.pending.append(queueHandle)
+            doneDeferred = queueHandle.whenDone()
+            doneDeferred.addCallbacks(self.sendNotification,
+                                      self.errorNotification,
+                                      errbackArgs=(queueHandle, stream))
+        return queueHandle
+
+    def resolveMany(self, chunkNames):
+        """
+        Resolve chunks with the resolver, all at once if it can.
 
-    def retrieve(self, chunks, background):
+        @return: a C{dict} that maps every chunk name to a L{Deferred}
+            that will be called with its locations.
         """
-        See L{Retrieve} command. 
+        if hasattr(self.resolver, 'resolveMany'):
+            return self.resolver.resolveMany(chunkNames)
+        return dict((chunkName, self.resolver.resolve(chunkName))
+                    for chunkName in chunkNames)
+
+    def cbPrefetch(self, locations, chunkName):
+        locations = list(locations)
+        if not locations:
+            raise ResolveError(chunkName)
+        return self.queueChunk(chunkName, locations, True).whenDone()
+
+    def prefetch(self, chunkNames):
         """
-        chunkNames = (d['chunkName'] for d in chunks)
+        Retrieve chunks in the background on behalf of the read-ahead.
 
-        # XXX: iterate through and collect items that are
-        # locally available.
+        @return: a C{dict} that maps every chunk name to a L{Deferred}
+            that will be called when the chunk is in the store.
+        """
+        resolving = self.resolveMany(chunkNames)
+        for chunkName, resolveDeferred in resolving.iteritems():
+            resolveDeferred.addCallback(self.cbPrefetch, chunkName)
+        return resolving
 
+    def retrieve(self, chunks, background, stream=None):
+        """
+        See L{Retrieve} command. 
+        """
+        chunkNames = list()
+        orders = dict()
+        for d in chunks:
+            chunkName = d['chunkName']
+            order = d.get('order')
+            if order is None:
+                order = self.sequence
+                self.sequence += 1
+            if self.downloader.store.hasChunk(chunkName):
+                # No need to resolve chunks that are already here.
+                self.queueChunk(chunkName, [], background, order, stream)
+            elif chunkName not in orders:
+                chunkNames.append(chunkName)
+                orders[chunkName] = order
+
+        if not background:
+            self.readAhead.accessed([d['chunkName'] for d in chunks])
+
+        # Chunks are queued as they are resolved, so that downloads
+        # start before the slowest lookup has finished.
+        resolving = self.resolveMany(chunkNames)
         deferreds = list()
         for chunkName in chunkNames:
-            deferreds.append(self.resolver.resolve(chunkName))
+            resolveDeferred = resolving[chunkName]
+            resolveDeferred.addCallback(self.cbResolve, chunkName,
+                                        background, orders[chunkName],
+                                        stream)
+            if stream:
+                resolveDeferred.addErrback(self.ebStream, chunkName,
+                                           background)
+            deferreds.append(resolveDeferred)
+        if stream:
+            return {}
+
+        def ebResolve(reason):
+            reason.trap(defer.FirstError)
+            return reason.value.subFailure
 
         completeDeferred = defer.DeferredList(deferreds,
-                                              fireOnOneErrback=1)
-        return completeDeferred.addCallback(self.cbResolve, chunkNames,
-                                            background)
+                                              fireOnOneErrback=1,
+                                              consumeErrors=1)
+        completeDeferred.addCallbacks(lambda ignore: {}, ebResolve)
+        return completeDeferred
     Retrieve.responder(retrieve)
 
+    def openFile(self, fileName, chunks):
+        """
+        See L{OpenFile} command.
+        """
+        self.readAhead.open(fileName, [d['chunkName'] for d in chunks])
+        return {}
+    OpenFile.responder(openFile)
+
+    def closeFile(self, fileName):
+        """
+        See L{CloseFile} command.
+        """
+        self.readAhead.close(fileName)
+        return {}
+    CloseFile.responder(closeFile)
+
+    def peerStatistics(self):
+        """
+        See L{PeerStatistics} command.
+        """
+        return {'peers': self.downloader.peers.describe()}
+    PeerStatistics.responder(peerStatistics)
+
+    def pin(self, chunks, pinned):
+        """
+        See L{Pin} command.  Stores without a quota never evict
+        chunks, so there is nothing to do for them.
+        """
+        store = self.downloader.store
+        if hasattr(store, 'pin'):
+            for d in chunks:
+                if pinned:
+                    store.pin(d['chunkName'])
+                else:
+                    store.unpin(d['chunkName'])
+        return {}
+    Pin.responder(pin)
+
     def shutdown(self):
         """Shutdown service.
         """
@@ -154,16 +361,20 @@ class ControlServerProtocol(amp.AMP):
 
 class ControlFactory(Factory):
 
-    def __init__(self, store, directoryService, dhtNode, resolver):
+    def __init__(self, store, directoryService, dhtNode, resolver,
+                 maxReadAhead=None):
         self.store = store
         self.directoryService = directoryService
         self.dhtNode = dhtNode
         self.resolver = resolver
+        self.maxReadAhead = maxReadAhead
+        self.downloader = Downloader(store, resolver=resolver)
 
     def buildProtocol(self, addr):
         from twisted.internet import reactor
         return ControlServerProtocol(self.resolver,
-                                     self.dhtNode,
-                                     reactor)
+                                     self.downloader,
+                                     reactor,
+                                     self.maxReadAhead)
 
     
@@ -1,32 +1,255 @@
+#
+
+from twisted.internet.protocol import Protocol
+from twisted.internet import defer
+from twisted.python import log, failure
+from twisted.web.http_headers import Headers
+from twisted.web import http
+from distfs.web.client import Agent, ResponseDone
+from distfs.error import DownloadError
+from distfs.util import ParallelQueue, FOREGROUND
+from distfs.hashing import digestAlgorithm
+from distfs.peers import PeerTable
+
+import time
+
+"""Retrieval of chunks from other nodes.
+"""
+
+
+def chunkURL(location, chunkName):
+    """
+    Return the URL of a chunk at the given location.
+
+    @param location: a contact as returned by L{IResolver.resolve}.
+    """
+    return 'http://%s:%d/%s' % (location.address, location.port, chunkName)
+
+
+class ChunkReceiver(Protocol):
+    """
+    Protocol that writes the body of a response to a store file.
+
+    @ivar finished: a L{Deferred} that will be called with the number
+        of received bytes when the whole body has been received.
+    """
+
+    def __init__(self, storeFile, finished):
+        self.storeFile = storeFile
+        self.finished = finished
+        self.received = 0
+
+    def dataReceived(self, bytes):
+        self.received += len(bytes)
+        self.storeFile.write(bytes)
+
+    def connectionLost(self, reason):
+        if reason.check(ResponseDone, http.PotentialDataLoss):
+            self.finished.callback(self.received)
+        else:
+            self.finished.errback(reason)
+
+
+def parseContentRange(value):
+    """
+    Parse the value of a I{Content-Range} header.
+
+    @return: a C{(start, end, size)} tuple where C{start} and C{end}
+        are C{None} for an unsatisfied range and C{size} is C{None} if
+        it is unknown.
+    """
+    unit, value = value.strip().split(' ', 1)
+    if unit.lower() != 'bytes':
+        raise ValueError(value)
+    span, size = value.split('/', 1)
+    size = size != '*' and int(size) or None
+    if span == '*':
+        return None, None, size
+    start, end = span.split('-', 1)
+    return int(start), int(end), size
+
+
+def fetchChunk(agent, url, storeFile, etag=None, start=None, end=None,
+               transfer=None, strict=False):
+    """
+    Download a chunk, or a range of it, into C{storeFile}.
+
+    By default the download starts after the data that has already
+    been written to C{storeFile}.  Should the server not honour the
+    range, the store file is truncated and the whole chunk is written
+    anew.  If the entity tag of the response is a digest, the store
+    file hashes the data with its algorithm.
+
+    @param agent: the HTTP client to use.
+    @type agent: L{Agent}
+    @param etag: entity tag of the data already in C{storeFile}, if
+        known; used to make sure the rest comes from the same entity.
+    @param start: offset of the first byte to fetch; defaults to
+        C{storeFile.written}.
+    @param end: offset of the last byte to fetch, or C{None} to fetch
+        up to the end of the chunk.
+    @param transfer: an optional L{Transfer} that is told about the
+        progress and outcome of the request.
+    @param strict: if C{True}, a response with an entity tag other
+        than C{etag} is rejected before its body is received.
+
+    @return: a L{Deferred} that will be called with the entity tag of
+        the response and the size of the whole chunk (C{None} if
+        unknown) when the data has been received.
+    """
+    if start is None:
+        start = storeFile.written
+    headers = Headers()
+    if start or end is not None:
+        last = ''
+        if end is not None:
+            last = str(end)
+        headers.addRawHeader('range', 'bytes=%d-%s' % (start, last))
+        if etag is not None:
+            headers.addRawHeader('if-range', etag)
+
+    def checkResponse(response):
+        """
+        Check that the response carries the data we asked for.
+
+        @return: the size of the whole chunk, if known.
+        """
+        size = None
+        if response.code == http.PARTIAL_CONTENT:
+            first, last, size = parseContentRange(
+                response.headers.getRawHeaders('content-range')[0])
+            if first != start:
+                raise DownloadError(url, 'unexpected range %d-%d'
+                                    % (first, last))
+        elif response.code == http.REQUESTED_RANGE_NOT_SATISFIABLE and start:
+            first, last, size = parseContentRange(
+                response.headers.getRawHeaders('content-range')[0])
+            if size != start:
+                storeFile.truncate()
+                raise DownloadError(url, 'partial data is larger than chunk')
+        elif response.code == http.OK:
+            if start:
+                storeFile.truncate()
+            lengths = response.headers.getRawHeaders('content-length')
+            if lengths:
+                size = int(lengths[0])
+        else:
+            raise DownloadError(url, '%d %s' % (response.code,
+                                                response.phrase))
+        if response.code == http.REQUESTED_RANGE_NOT_SATISFIABLE:
+            return size
+        responseTag = response.headers.getRawHeaders('etag', [None])[0]
+        if strict and responseTag != etag:
+            raise DownloadError(url, 'unexpected entity tag %s'
+                                % responseTag)
+        algorithm = responseTag and digestAlgorithm(responseTag.strip('"'))
+        if algorithm and hasattr(storeFile, 'useAlgorithm'):
+            # Hash with the algorithm the location used before the
+            # body arrives, so that it is hashed only once.
+            storeFile.useAlgorithm(algorithm)
+        return size
+
+    def cbResponse(response):
+        try:
+            size = checkResponse(response)
+        except:
+            # Do not let the body pile up in memory.
+            response.deliverBody(_Abort())
+            raise
+        if transfer is not None:
+            transfer.responseReceived()
+        if response.code == http.REQUESTED_RANGE_NOT_SATISFIABLE:
+            # Everything had already been received.
+            return etag, size
+
+        responseTag = response.headers.getRawHeaders('etag', [None])[0]
+
+        def cbBody(received):
+            if transfer is not None:
+                transfer.done(received)
+            return responseTag, size
+
+        finished = defer.Deferred()
+        response.deliverBody(ChunkReceiver(storeFile, finished))
+        return finished.addCallback(cbBody)
+
+    def ebRequest(reason):
+        if transfer is not None:
+            transfer.failed()
+        return reason
+
+    requestDeferred = agent.request('GET', url, headers, None)
+    return requestDeferred.addCallback(cbResponse).addErrback(ebRequest)
+
+
+class _Abort(Protocol):
+    """
+    Protocol that drops the connection of a response body that is of
+    no use to us.
+    """
+
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+
+class StripeWriter(object):
+    """
+    Writes one stripe of a chunk into its place in a store file.
+
+    A server that answers a range request with the whole chunk is of
+    no use for striping, so L{truncate} refuses rather than throwing
+    away the other stripes.
+    """
+
+    def __init__(self, storeFile, offset):
+        self.storeFile = storeFile
+        self.offset = offset
+        self.written = 0
+
+    def write(self, bytes):
+        self.storeFile.writeAt(self.offset + self.written, bytes)
+        self.written += len(bytes)
+
+    def truncate(self, size=0):
+        raise DownloadError(self.storeFile, 'location does not support ranges')
+
 
 class QueueHandle(object):
+    """
+    Handle for a client that waits for a chunk to be downloaded.
+
+    Any number of handles can wait for the same L{Download}.
+
+    @ivar download: the download this handle waits for, or C{None} if
+        the chunk was already in the store.
+    """
 
     def __init__(self, downloader, chunkName, locations):
         self.downloader = downloader
         self.chunkName = chunkName
+        self.locations = locations
+        self.download = None
         self.deferred = defer.Deferred()
-        
+
     def cancel(self):
         """
-        Cancel the download of this chunk.
+        Stop waiting for this chunk.  The download is cancelled when
+        no other handle waits for it and it has not started yet.
         """
-        self.deferred = None
         self.downloader.cancel(self)
 
     def notify(self):
         """
         Notify listeners that this chunk has been downloaded.
         """
-        d, self.deferred = self.deferred, None
-        if d is not None:
-            d.callback(None)
+        if not self.deferred.called:
+            self.deferred.callback(self)
 
-    def error(self):
-        d, self.deferred = self.deferred, None
-        if d is not None:
-            d.errback(None)
+    def error(self, reason):
+        if not self.deferred.called:
+            self.deferred.errback(reason)
 
-    def whenDone():
+    def whenDone(self):
         """
         Return a L{Deferred} that will be called when the chunk has
         been fetched.
@@ -42,53 +265,410 @@ class QueueHandle(object):
         self.errback = callable
 
 
+class Download(object):
+    """
+    A chunk that is queued or being downloaded, shared by all handles
+    that wait for it.
+
+    @ivar locations: all locations known for the chunk.
+    @ivar priority: the most urgent priority class of the handles.
+    @ivar handles: the L{QueueHandle}s that wait for the chunk.
+    @ivar started: C{True} once the download has left the queue.
+    """
+
+    def __init__(self, chunkName, locations):
+        self.chunkName = chunkName
+        self.locations = list(locations)
+        self.priority = None
+        self.handles = list()
+        self.started = False
+
+
+class ConcurrencyController(object):
+    """
+    Adjusts the number of downloads that a L{ParallelQueue} runs at
+    the same time, using additive increase and multiplicative
+    decrease.
+
+    Completed downloads are accounted in windows of C{interval}
+    seconds.  At the end of a window the limit is halved if more than
+    C{errorThreshold} of the downloads failed, or if the goodput fell
+    below C{tolerance} of the previous window after the limit was
+    raised.  Otherwise the limit is raised by one, but only if
+    downloads were waiting for a free slot during the window, since
+    the window says nothing about a higher limit otherwise.  A raise
+    that did not improve the goodput is undone.
+
+    @ivar limit: current limit; the queue runs C{int(limit)} tasks.
+    @ivar goodput: bytes per second delivered in the previous window.
+    """
+
+    minimum = 1
+    maximum = 64
+    interval = 5.0
+    errorThreshold = 0.2
+    tolerance = 0.9
+    backoff = 0.5
+
+    def __init__(self, queue, clock=time.time):
+        self.queue = queue
+        self.clock = clock
+        self.limit = float(queue.maxProcessing)
+        self.goodput = None
+        self.raised = False
+        self._reset(clock())
+
+    def _reset(self, now):
+        self.windowStart = now
+        self.bytes = 0
+        self.completed = 0
+        self.failures = 0
+        self.saturated = False
+
+    def record(self, bytes, failed=False):
+        """
+        Account a finished download of C{bytes} bytes.
+        """
+        self.bytes += bytes
+        self.completed += 1
+        if failed:
+            self.failures += 1
+        if len(self.queue):
+            self.saturated = True
+        now = self.clock()
+        if now - self.windowStart >= self.interval:
+            self.adjust(now - self.windowStart)
+            self._reset(now)
+
+    def succeeded(self, bytes):
+        self.record(bytes)
+        return bytes
+
+    def failed(self, reason):
+        self.record(0, True)
+        return reason
+
+    def adjust(self, elapsed):
+        """
+        Pick a new limit at the end of a window of C{elapsed}
+        seconds.
+        """
+        goodput = self.bytes / elapsed
+        errorRate = float(self.failures) / self.completed
+        if errorRate > self.errorThreshold or (
+            self.raised and goodput < self.goodput * self.tolerance):
+            self.limit = max(self.minimum, self.limit * self.backoff)
+            self.raised = False
+        elif self.raised and goodput <= self.goodput:
+            # The last raise did not help; undo it.
+            self.limit = max(self.minimum, self.limit - 1)
+            self.raised = False
+        elif self.saturated:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.raised = True
+        else:
+            self.raised = False
+        self.goodput = goodput
+        self.queue.maxProcessing = int(self.limit)
+        self.queue.schdule()
+
 
 class Downloader(object):
     """
     Downloader.
 
+    Data that has been received from a location that fails half-way
+    is kept, and the download continues from where it stopped at the
+    next location.  If all locations fail the partial data is left in
+    the store so that a later download of the same chunk can resume.
+
+    When a chunk has several locations and is larger than one stripe,
+    the first stripe is fetched from one location and the rest of the
+    chunk is split into stripes that are fetched from up to
+    C{maxStripeSources} locations at the same time.
+
     @ivar store: a L{I downloaded chunks will be stored
-    @type store: L{IStore} 
+    @type store: L{IStore}
+
+    @ivar agent: HTTP client used to fetch chunks.
+    @type agent: L{Agent}
+
+    @ivar peers: statistics about the locations chunks have been
+        fetched from, used to try the most promising locations first.
+    @type peers: L{PeerTable}
+
+    @ivar concurrency: controller that adapts the number of chunks
+        that are downloaded at the same time to the observed goodput
+        and error rate.
+    @type concurrency: L{ConcurrencyController}
+
+    @ivar stripeSize: size of the ranges a chunk is split into when it
+        is fetched from several locations; C{0} disables striping.
+    @ivar maxStripeSources: maximum number of locations a single
+        chunk is fetched from at the same time.
+    @ivar verifyNames: if C{True}, chunks named after the digest of
+        their content are checked against their name.  Locations that
+        announce other content are skipped without fetching it.
+    @ivar resolver: the resolver the locations came from, or C{None}.
+        If it has an C{invalidate} method it is told about locations
+        that fail to serve a chunk.
     """
 
-    def __init__(self, store):
+    stripeSize = 4 * 1024 * 1024
+    maxStripeSources = 4
+    verifyNames = True
+
+    def __init__(self, store, agent=None, resolver=None):
         self.store = store
-        self.handles = list()
-        self.queue = ParallelQueue(self.startDownload)
+        self.resolver = resolver
+        if agent is None:
+            from twisted.internet import reactor
+            agent = Agent(reactor)
+        self.agent = agent
+        self.peers = PeerTable()
+        self.downloads = dict()
+        self.queue = ParallelQueue(self.runDownload)
+        self.concurrency = ConcurrencyController(self.queue)
+
+    def runDownload(self, download):
+        """
+        Callback from the download queue; download the chunk and
+        account the outcome with the concurrency controller.
+        """
+        download.started = True
+        downloadDeferred = self.startDownload(download)
+        return downloadDeferred.addCallbacks(self.concurrency.succeeded,
+                                             self.concurrency.failed)
 
     @defer.inlineCallbacks
-    def startDownload(self, queueHandle):
+    def startDownload(self, download):
         """
-        Callback from the download queue that instructs us to start to
-        download the chunk described by the given queue handle.
+        Download the chunk described by the given L{Download}.
+
+        @return: a L{Deferred} that will be called with the size of the
+            chunk when it is in the store.
         """
-        locations = list(queueHandler.locations)
-        random.shuffle(locations)
-        for location in locations:
-            f = self.store.store(queueHandle.chunkName)
+        chunkName = download.chunkName
+        locations = self.peers.rank(download.locations)
+        storeFile = self.store.store(chunkName, resume=True)
+        expected = self.expectedDigest(chunkName)
+        etag = None
+        if expected is not None:
+            etag = '"%s"' % expected
+            storeFile.useAlgorithm(digestAlgorithm(expected))
+        # Data left by an earlier attempt is not vouched for by any of
+        # the locations.
+        resumed = storeFile.written > 0
+        while locations:
+            location = locations.pop(0)
+            url = chunkURL(location, chunkName)
+            end = None
+            if self.stripeSize and locations:
+                # Only ask for the first stripe; the answer tells us
+                # how big the chunk is.
+                end = storeFile.written + self.stripeSize - 1
             try:
-                value = yield downloadPage(location, f)
-            except:
+                etag, size = yield fetchChunk(
+                    self.agent, url, storeFile, etag, end=end,
+                    transfer=self.peers.transfer(location),
+                    strict=expected is not None)
+            except Exception:
+                log.err(None, "failed to download %s" % url)
+                self.locationFailed(chunkName, location)
+                continue
+
+            digest = etag and etag.strip('"')
+            if not (digest and digestAlgorithm(digest)):
+                digest = None
+
+            sources = [location]
+            if size is not None and storeFile.written < size:
+                try:
+                    used = yield self.fetchStripes(
+                        chunkName, [location] + locations, storeFile, etag,
+                        size)
+                    sources.extend(source for source in used
+                                   if source is not location)
+                except Exception:
+                    log.err(None, "failed to download stripes of %s"
+                            % chunkName)
+                    break
+
+            if digest is not None and storeFile.digest() != digest:
+                log.msg("digest of %s does not match %s" % (chunkName, etag))
+                storeFile.truncate()
+                etag = expected is not None and '"%s"' % expected or None
+                if resumed:
+                    # The resumed data may be what is wrong; fetch the
+                    # whole chunk from the same location again before
+                    # blaming anyone.
+                    resumed = False
+                    locations.insert(0, location)
+                    continue
+                # Throw the data away and try the locations that did
+                # not contribute to it.
+                for source in sources:
+                    self.locationFailed(chunkName, source)
+                    if source in locations:
+                        locations.remove(source)
                 continue
-            defer.returnValue(None)
+            size = storeFile.written
+            yield defer.maybeDeferred(storeFile.close)
+            defer.returnValue(size)
 
-        raise Exception("could not download anything")
+        storeFile.suspend()
+        raise DownloadError(chunkName, "could not download from any location")
+
+    def locationFailed(self, chunkName, location):
+        """
+        Tell the resolver that a location, or all locations if
+        C{location} is C{None}, did not serve a chunk.
+        """
+        if self.resolver is not None and hasattr(self.resolver,
+                                                 'invalidate'):
+            self.resolver.invalidate(chunkName, location)
+
+    def expectedDigest(self, chunkName):
+        """
+        Return the digest that the content of the specified chunk must
+        have, or C{None} if it is only known once a location has
+        answered.
+        """
+        if self.verifyNames and digestAlgorithm(chunkName):
+            return chunkName
+        return None
+
+    @defer.inlineCallbacks
+    def fetchStripes(self, chunkName, locations, storeFile, etag, size):
+        """
+        Fetch the part of a chunk beyond C{storeFile.written} as
+        stripes from several locations in parallel.
+
+        A location that fails hands its stripe back to the others and
+        is not used again.  If stripes are left when all locations
+        have failed, the store file is truncated to the stripes that
+        were received in one piece from the start so that the download
+        can be resumed later.
+
+        @return: a L{Deferred} that will be called with the list of
+            locations that delivered stripes.
+        """
+        first = storeFile.written
+        stripes = [(start, min(start + self.stripeSize, size) - 1)
+                   for start in xrange(first, size, self.stripeSize)]
+        pending = list(stripes)
+        completed = set()
+
+        @defer.inlineCallbacks
+        def fetchFrom(location):
+            url = chunkURL(location, chunkName)
+            while pending:
+                start, end = pending.pop(0)
+                try:
+                    yield fetchChunk(self.agent, url,
+                                     StripeWriter(storeFile, start), etag,
+                                     start, end,
+                                     self.peers.transfer(location),
+                                     etag is not None)
+                except Exception:
+                    log.err(None, "failed to download %s" % url)
+                    self.locationFailed(chunkName, location)
+                    pending.append((start, end))
+                    defer.returnValue(False)
+                completed.add(start)
+                if location not in used:
+                    used.append(location)
+            defer.returnValue(True)
+
+        sources = locations[:self.maxStripeSources]
+        used = list()
+        while pending and sources:
+            results = yield defer.DeferredList(
+                [fetchFrom(location) for location in sources])
+            sources = [location for (location, (success, healthy))
+                       in zip(sources, results) if healthy]
+
+        if pending:
+            received = first
+            for start, end in stripes:
+                if start not in completed:
+                    break
+                received = end + 1
+            storeFile.truncate(received)
+            raise DownloadError(chunkName, "%d stripes could not be fetched"
+                                % len(pending))
+        defer.returnValue(used)
 
     def cancel(self, queueHandle):
-        pass
+        """
+        Stop waiting for a chunk on behalf of the given handle.  The
+        download is removed from the queue when no handle waits for
+        it any more, unless it has already started.
+        """
+        download = queueHandle.download
+        if download is None or queueHandle not in download.handles:
+            return
+        download.handles.remove(queueHandle)
+        if not download.handles and not download.started:
+            self.queue.remove(download)
+            del self.downloads[download.chunkName]
+
+    def _enqueue(self, download, priority, client, order):
+        download.priority = priority
+        completedDeferred = self.queue.add(download, priority, client,
+                                           order)
+        completedDeferred.addBoth(self._finished, download)
 
-    def add(self, chunkName, locations):
+    def _finished(self, result, download):
+        if self.downloads.get(download.chunkName) is download:
+            del self.downloads[download.chunkName]
+        for queueHandle in download.handles:
+            if isinstance(result, failure.Failure):
+                queueHandle.error(result)
+            else:
+                queueHandle.notify()
+
+    def add(self, chunkName, locations, priority=FOREGROUND, client=None,
+            order=0):
         """
         Tell the downloader to try to retrieve the specified chunk from
         one of the given locations.
 
+        A chunk is downloaded only once no matter how many times it is
+        added; later handles wait for the download that is already
+        queued or running, and their locations are added to it.  A
+        chunk that is already in the store is not downloaded at all.
+
+        @param priority: priority class of the download; see
+            L{ParallelQueue.add}.
+        @param client: the client that wants the chunk.
+        @param order: ordering hint among the chunks of the client;
+            see L{ParallelQueue.add}.
+
         @return: a queue handle
         @rtype: L{QueueHandle}
         """
-        queueHandler = QueueHandler(self, chunkName, locations)
-        completedDeffered = self.queue.add(queueHandler)
-        completedDeffered.addCallback(lambda result: queueHandler.notify())
-        completedDeferred.addErrback(lambda result: queueHandler.error())
-        return queueHandler
+        queueHandle = QueueHandle(self, chunkName, locations)
+        if self.store.hasChunk(chunkName):
+            queueHandle.notify()
+            return queueHandle
 
+        download = self.downloads.get(chunkName)
+        if download is None:
+            download = self.downloads[chunkName] = Download(chunkName,
+                                                            locations)
+            self._enqueue(download, priority, client, order)
+        else:
+            known = set(self.peers.key(location)
+                        for location in download.locations)
+            for location in locations:
+                if self.peers.key(location) not in known:
+                    download.locations.append(location)
+            if not download.started and priority < download.priority:
+                # Move the download up to the more urgent class.
+                self.queue.remove(download)
+                self._enqueue(download, priority, client, order)
 
+        queueHandle.download = download
+        download.handles.append(queueHandle)
+        return queueHandle
@@ -3,3 +3,9 @@ class NoSuchChunkError(Exception):
     """
 
 
+
+
+class DownloadError(Exception):
+    """
+    A chunk could not be downloaded.
+    """
@@ -0,0 +1,130 @@
+#
+
+import hashlib
+import zlib
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+"""Hash algorithms for chunk digests and checksums.
+
+Digests are written as C{algorithm:hexdigest} so that the algorithm
+a chunk was hashed with is recorded wherever its digest is, including
+the entity tags of chunk responses.  SHA-1 digests are written as the
+bare hex digest, as they always have been, so that nodes that only
+know SHA-1 still understand them.
+"""
+
+
+algorithms = {'sha1': hashlib.sha1}
+if blake2b is not None:
+    algorithms['blake2b'] = blake2b
+
+if 'blake2b' in algorithms:
+    defaultAlgorithm = 'blake2b'
+else:
+    defaultAlgorithm = 'sha1'
+
+
+def newHash(algorithm):
+    """
+    Return a new hash object for the specified algorithm.
+
+    @raise ValueError: if the algorithm is not available.
+    """
+    try:
+        return algorithms[algorithm]()
+    except KeyError:
+        raise ValueError("unknown hash algorithm: %s" % (algorithm,))
+
+
+def formatDigest(algorithm, hexdigest):
+    """
+    Return the digest string recorded for a chunk.
+    """
+    if algorithm == 'sha1':
+        return hexdigest
+    return '%s:%s' % (algorithm, hexdigest)
+
+
+def parseDigest(digest):
+    """
+    Split a digest string into the algorithm and the hex digest.
+    """
+    if ':' in digest:
+        return tuple(digest.split(':', 1))
+    return 'sha1', digest
+
+
+def digestAlgorithm(value):
+    """
+    Return the algorithm of C{value} if it is a digest string of an
+    available algorithm, otherwise C{None}.
+
+    This is used to tell chunks that are named after their content
+    from other chunks.
+    """
+    algorithm, hexdigest = parseDigest(value)
+    if algorithm not in algorithms:
+        return None
+    if len(hexdigest) != newHash(algorithm).digest_size * 2:
+        return None
+    if hexdigest != hexdigest.lower():
+        return None
+    try:
+        int(hexdigest, 16)
+    except ValueError:
+        return None
+    return algorithm
+
+
+def chunkAlgorithm(chunkName, default):
+    """
+    Return the algorithm to hash a chunk with: the algorithm of its
+    name if it is named after its content, so that the digest the
+    chunk is served with matches its name, C{default} otherwise.
+    """
+    return digestAlgorithm(chunkName) or default
+
+
+class Checksum(object):
+    """
+    Fast non-cryptographic checksum used to look for data that has
+    gone bad on disk.
+
+    Uses xxHash when the C{xxhash} module is installed and Adler-32
+    otherwise; L{name} tells which, so that a recorded checksum is only
+    compared with one computed the same way.
+    """
+
+    if xxhash is not None:
+        name = 'xxh64'
+    else:
+        name = 'adler32'
+
+    def __init__(self):
+        if xxhash is not None:
+            self._hash = xxhash.xxh64()
+        else:
+            self._value = zlib.adler32('')
+
+    def update(self, data):
+        if xxhash is not None:
+            self._hash.update(data)
+        else:
+            self._value = zlib.adler32(data, self._value)
+
+    def hexdigest(self):
+        if xxhash is not None:
+            return '%s:%s' % (self.name, self._hash.hexdigest())
+        return '%s:%08x' % (self.name, self._value & 0xffffffff)
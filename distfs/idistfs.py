@@ -28,6 +28,66 @@ class IStore(Interface):
             chunk size and its hash digest.
         """
 
+    def locate(chunkName):
+        """
+        Locate the bytes of the specified chunk.
+
+        @return: a C{tuple} with an absolute path to the file that
+            holds the chunk, the offset of the chunk within the file
+            and the chunk size.
+        """
+
+    def store(chunkName, resume=False):
+        """
+        Return a file-like object that is used to write content to
+        the chunk.  The chunk is available once the C{close} method
+        of the file has been called; C{close} may return a Deferred.
+
+        The file has a C{written} attribute with the number of bytes
+        in it, a C{writeAt} method for writing at an offset, a
+        C{digest} method, a C{useAlgorithm} method that selects the
+        hash algorithm, a C{truncate} method that throws away data,
+        and a C{suspend} method that closes the file but keeps the
+        data so that it can be picked up again by passing
+        C{resume=True}.
+
+        Digests are formatted as described in L{distfs.hashing}.
+        """
+
+    def remove(chunkName):
+        """
+        Remove the specified chunk from the store.
+        """
+
+    def iterChunks():
+        """
+        Iterate through the names of all chunks in the store.
+        """
+
+    def addObserver(observer):
+        """
+        Tell the L{IStoreObserver} C{observer} about chunks that are
+        added to or removed from the store from now on.
+        """
+
+    def removeObserver(observer):
+        """
+        Stop telling C{observer} about changes to the store.
+        """
+
+
+class IStoreObserver(Interface):
+
+    def chunkAdded(chunkName):
+        """
+        The specified chunk has been made available in the store.
+        """
+
+    def chunkRemoved(chunkName):
+        """
+        The specified chunk has been removed from the store.
+        """
+
 class IResolver(Interface):
 
     def resolve(chunk):
@@ -36,6 +96,15 @@ class IResolver(Interface):
         can be found.
         """
 
+    def resolveMany(chunks):
+        """
+        Resolve many chunks at once.
+
+        @return: a C{dict} that maps every chunk to a L{Deferred} that
+            will be called with its list of locations as soon as it has
+            been resolved.
+        """
+
 class IPublisher(Interface):
 
     def publish(chunk):
@@ -44,6 +113,18 @@ class IPublisher(Interface):
         at this node.
         """
 
+    def publishMany(chunks):
+        """
+        Publish that all the specified chunks can be found at this
+        node.
+        """
+
+    def unpublish(chunk):
+        """
+        Withdraw from the network that the specified chunk can be
+        found at this node.
+        """
+
 
 class IDirectoryService(Interface):
     """
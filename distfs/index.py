@@ -0,0 +1,113 @@
+#
+
+import sqlite3
+import os
+
+"""Persistent index over the chunks in a store.
+"""
+
+
+class ChunkIndex(object):
+    """
+    Index that maps chunk names to their size, hash digest and
+    modification time.
+
+    All entries are kept in memory so that lookups never touch the
+    file system.  Changes are written through to a SQLite database so
+    that the index can be loaded when the store is opened again
+    instead of being rebuilt from a full scan of the store.
+
+    @ivar entries: a C{dict} that maps chunk names to C{(size, digest,
+        mtime)} tuples.
+    @ivar created: C{True} if the database did not exist before and
+        the index has to be populated by the owner.
+    """
+
+    def __init__(self, dbFile):
+        """
+        @param dbFile: path to the SQLite database that backs the
+            index.
+        """
+        self.created = not os.path.exists(dbFile)
+        self._db = sqlite3.connect(dbFile)
+        self._db.isolation_level = None
+        self._db.text_factory = str
+        if self.created:
+            self._db.execute('CREATE TABLE chunks(name PRIMARY KEY, size, '
+                             'digest, mtime)')
+        self.entries = dict()
+        for name, size, digest, mtime in self._db.execute(
+            'SELECT name, size, digest, mtime FROM chunks'):
+            self.entries[name] = (size, digest, mtime)
+
+    def __contains__(self, chunkName):
+        return chunkName in self.entries
+
+    def __iter__(self):
+        return iter(self.entries.keys())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, chunkName):
+        """
+        Return a C{(size, digest, mtime)} tuple for the specified
+        chunk, or C{None} if the chunk is not in the index.
+        """
+        return self.entries.get(chunkName)
+
+    def add(self, chunkName, size, digest, mtime):
+        """
+        Add or replace the entry for the specified chunk.
+        """
+        self.entries[chunkName] = (size, digest, mtime)
+        self._db.execute('INSERT OR REPLACE INTO chunks(name, size, digest, '
+                         'mtime) VALUES (?, ?, ?, ?)',
+                         (chunkName, size, digest, mtime))
+
+    def addMany(self, entries):
+        """
+        Add or replace the entries for several chunks in a single
+        transaction.
+
+        @param entries: an iterable of C{(chunkName, size, digest,
+            mtime)} tuples.
+        """
+        entries = list(entries)
+        for chunkName, size, digest, mtime in entries:
+            self.entries[chunkName] = (size, digest, mtime)
+        self._db.execute('BEGIN')
+        self._db.executemany('INSERT OR REPLACE INTO chunks(name, size, '
+                             'digest, mtime) VALUES (?, ?, ?, ?)', entries)
+        self._db.execute('COMMIT')
+
+    def remove(self, chunkName):
+        """
+        Remove the entry for the specified chunk, if there is one.
+        """
+        if self.entries.pop(chunkName, None) is not None:
+            self._db.execute('DELETE FROM chunks WHERE name=?', (chunkName,))
+
+    def replace(self, entries):
+        """
+        Replace the whole content of the index.
+
+        @param entries: an iterable of C{(chunkName, size, digest,
+            mtime)} tuples.
+        """
+        self.entries = dict()
+        for chunkName, size, digest, mtime in entries:
+            self.entries[chunkName] = (size, digest, mtime)
+        self._db.execute('BEGIN')
+        self._db.execute('DELETE FROM chunks')
+        self._db.executemany('INSERT INTO chunks(name, size, digest, mtime) '
+                             'VALUES (?, ?, ?, ?)',
+                             ((name,) + entry
+                              for (name, entry) in self.entries.iteritems()))
+        self._db.execute('COMMIT')
+
+    def close(self):
+        """
+        Close the underlying database.
+        """
+        self._db.close()
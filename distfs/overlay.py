@@ -1,65 +1,748 @@
 from zope.interface import implements
-from distfs import idistfs
+from distfs import idistfs, util
 from twisted.internet import defer
+from twisted.python import log, failure
+from entangled.kademlia.node import Node, rpcmethod
+from entangled.kademlia.protocol import TimeoutError
+from entangled.kademlia import constants
+from collections import OrderedDict
+
+import time
+
+
+def commonPrefix(keyOne, keyTwo):
+    """
+    Return the number of leading bits that two keys have in common.
+    """
+    distance = long(keyOne.encode('hex'), 16) ^ long(keyTwo.encode('hex'), 16)
+    return len(keyOne) * 8 - distance.bit_length()
+
+
+class Provider(object):
+    """
+    A node that provides a chunk, as told by its provider record.
+
+    @ivar id: node ID of the provider.
+    @ivar address: IP address the provider serves chunks on.
+    @ivar port: HTTP port the provider serves chunks on.
+    @ivar published: when the record was stored, by the clock of the
+        node that holds it.
+    """
+
+    def __init__(self, id, address, port, published):
+        self.id = id
+        self.address = address
+        self.port = port
+        self.published = published
+
+
+def recordKey(chunkName):
+    """
+    Return the DHT key that the provider records of a chunk are
+    stored under.  The older lists of provider IDs are stored under
+    the SHA-1 digest of the chunk name.
+    """
+    return util.shadigest('providers:' + chunkName)
+
+
+def parseProviders(value):
+    """
+    Return the provider records in a value stored under a record key
+    as a C{dict} that maps node IDs to C{[address, port, published]}
+    lists.
+
+    Records are stored as a list of C{[nodeID, address, port,
+    published]} lists, rather than as a C{dict}, since nodes that
+    predate the records cannot decode nested dictionaries.  Plain node
+    IDs, as in the older lists, are read as providers whose address is
+    not known, as are records with an empty address.
+    """
+    providers = dict()
+    for entry in value:
+        if type(entry) in (list, tuple):
+            providers[entry[0]] = list(entry[1:4])
+        else:
+            providers[entry] = ['', 0, 0]
+    return providers
+
+
+def formatProviders(providers):
+    """
+    Return the value to store for the records returned by
+    L{parseProviders}.
+    """
+    return [[providerID] + record
+            for providerID, record in sorted(providers.iteritems())]
+
+
+class OverlayNode(Node):
+    """
+    Kademlia node that can record this node as a provider of many
+    keys with a single RPC per responsible node.
+
+    Keys are either record keys, whose values hold provider records
+    (see L{parseProviders}), or legacy keys, whose values are plain
+    lists of provider IDs.  The node that receives a record fills in
+    the address the provider contacted it from, so that resolvers can
+    reach the provider without looking it up.
+
+    @ivar httpPort: the port this node serves chunks on, if it is not
+        the same as its UDP port.
+
+    @cvar maxBatch: most keys sent in a single C{addProviders} RPC.
+    @cvar lookups: most node lookups that L{iterateGroups} runs at
+        the same time.
+    @cvar maxRPCs: most C{findValue} RPCs that L{iterativeFindValues}
+        sends at the same time.
+    """
+
+    maxBatch = 256
+    lookups = 4
+    maxRPCs = 16
+    httpPort = None
+
+    @rpcmethod
+    def addProviders(self, keys, providerID=None, port=None, legacy=0,
+                     **kwargs):
+        """
+        Add a node to the providers stored under the given keys.
+        Records older than the DHT expiry time are dropped on the way.
+
+        @param keys: the hashtable keys.
+        @param providerID: ID of the providing node; defaults to the
+            node that sent the RPC.
+        @param port: HTTP port of the providing node; defaults to its
+            UDP port.
+        @param legacy: if true, the keys are legacy keys.
+        """
+        if providerID is None:
+            providerID = kwargs.get('_rpcNodeID')
+            if providerID is None:
+                raise TypeError('No provider specified, and RPC caller ID '
+                                'not available.')
+        now = int(time.time())
+        record = ['', port or 0, now]
+        if providerID != self.id:
+            try:
+                contact = self._routingTable.getContact(providerID)
+            except ValueError:
+                pass
+            else:
+                record = [contact.address, port or contact.port, now]
+        expired = now - constants.dataExpireTimeout
+        for key in keys:
+            value = list()
+            if key in self._dataStore:
+                value = self._dataStore[key]
+            if legacy:
+                if providerID in value:
+                    continue
+                value = list(value) + [providerID]
+            else:
+                providers = parseProviders(value)
+                for otherID, (address, otherPort, published) in \
+                        providers.items():
+                    if published and published < expired:
+                        del providers[otherID]
+                providers[providerID] = record
+                value = formatProviders(providers)
+            self._dataStore.setItem(key, value, now, now, providerID)
+        return 'OK'
+
+    def _legacyAddProviders(self, contact, keys, providerID, legacy):
+        """
+        Add a provider, one key at a time, at a node that does not
+        know C{addProviders}.
+        """
+        def store(result, key):
+            value = list()
+            if type(result) == dict:
+                value = result.get(key, ())
+            if legacy:
+                if providerID in value:
+                    return None
+                value = list(value) + [providerID]
+            else:
+                providers = parseProviders(value)
+                if providerID in providers:
+                    return None
+                providers[providerID] = ['', self.httpPort or self.port,
+                                         int(time.time())]
+                value = formatProviders(providers)
+            return contact.store(key, value, providerID)
+
+        def addProvider(key):
+            findDeferred = contact.findValue(key)
+            return findDeferred.addCallback(store, key)
+
+        semaphore = defer.DeferredSemaphore(constants.alpha)
+        return defer.DeferredList([semaphore.run(addProvider, key)
+                                   for key in keys], consumeErrors=True)
+
+    def _sendProviders(self, contact, keys, providerID, legacy):
+        def ebSend(reason, batch):
+            if reason.check(TimeoutError):
+                return reason
+            # Nodes that predate the RPC answer with an error.
+            return self._legacyAddProviders(contact, batch, providerID,
+                                            legacy)
+
+        ds = list()
+        for start in xrange(0, len(keys), self.maxBatch):
+            batch = keys[start:start + self.maxBatch]
+            sendDeferred = contact.addProviders(batch, providerID,
+                                                self.httpPort or self.port,
+                                                legacy and 1 or 0)
+            ds.append(sendDeferred.addErrback(ebSend, batch))
+        return defer.DeferredList(ds, consumeErrors=True)
+
+    def _storeGroup(self, nodes, keys, providerID, legacy):
+        """
+        Send the provider records for a group of keys to the nodes
+        that are closest to them.
+        """
+        key = keys[0]
+        if len(nodes) >= constants.k:
+            if (self._routingTable.distance(key, self.id)
+                < self._routingTable.distance(key, nodes[-1].id)):
+                nodes.pop()
+                self.addProviders(keys, providerID, self.httpPort, legacy)
+        else:
+            self.addProviders(keys, providerID, self.httpPort, legacy)
+        return defer.DeferredList([self._sendProviders(contact, keys,
+                                                       providerID, legacy)
+                                   for contact in nodes])
+
+    def _groupBits(self, key, nodes):
+        """
+        Return how many leading bits a key must share with C{key} to
+        have the same closest nodes, given the closest nodes to C{key}.
+        """
+        if len(nodes) < constants.k:
+            return 0
+        return commonPrefix(key, nodes[-1].id) + 1
+
+    def iterateGroups(self, keys, handleGroup, description):
+        """
+        Look up the closest nodes for groups of keys that share them,
+        and call C{handleGroup(nodes, group)} for every group.
+
+        Keys that are close enough to each other to have the same
+        closest nodes, which is when they share more leading bits than
+        the furthest of those nodes does, are handled together after a
+        single lookup.  The keys are taken in sorted order: the first
+        key that is left leads a group, which is first estimated from
+        the routing table and corrected once the lookup for the leader
+        has found the closest nodes.  Many keys thus need about one
+        lookup per neighbourhood rather than one per key.  No more
+        than C{lookups} groups are handled at a time.
+
+        @param handleGroup: callable that may return a L{Deferred}.
+        @param description: what is being done, for the log.
+        @return: a L{Deferred} that will be called when all groups have
+            been handled.
+        """
+        remaining = sorted(set(keys), reverse=True)
+        doneDeferred = defer.Deferred()
+        state = {'running': 0}
+
+        def takeGroup(leader, group, bits):
+            while remaining and commonPrefix(leader, remaining[-1]) >= bits:
+                group.append(remaining.pop())
+
+        def cbLookup(nodes, leader, group):
+            bits = self._groupBits(leader, nodes)
+            others = [key for key in group if commonPrefix(leader, key) < bits]
+            if others:
+                remaining.extend(others)
+                remaining.sort(reverse=True)
+                group = [key for key in group
+                         if commonPrefix(leader, key) >= bits]
+            takeGroup(leader, group, bits)
+            return handleGroup(nodes, group)
+
+        def finished(result):
+            state['running'] -= 1
+            if isinstance(result, failure.Failure):
+                log.err(result, description)
+            startLookups()
+
+        def startLookups():
+            while remaining and state['running'] < self.lookups:
+                leader = remaining.pop()
+                group = [leader]
+                takeGroup(leader, group, self._groupBits(
+                    leader, self._routingTable.findCloseNodes(leader,
+                                                              constants.k)))
+                state['running'] += 1
+                lookupDeferred = self.iterativeFindNode(leader)
+                lookupDeferred.addCallback(cbLookup, leader, group)
+                lookupDeferred.addBoth(finished)
+            if not remaining and not state['running'] \
+                    and not doneDeferred.called:
+                doneDeferred.callback(None)
+
+        startLookups()
+        return doneDeferred
+
+    def iterativeAddProviders(self, keys, providerID=None, legacy=False):
+        """
+        Record C{providerID}, this node by default, as a provider of
+        all the given keys, which are legacy keys if C{legacy} is true.
+
+        The keys are grouped by L{iterateGroups}, so a store with many
+        chunks needs about one lookup, and one RPC per closest node,
+        per neighbourhood rather than a lookup per chunk.
+
+        @return: a L{Deferred} that will be called when all records
+            have been sent.
+        """
+        if providerID is None:
+            providerID = self.id
+
+        def storeGroup(nodes, group):
+            return self._storeGroup(nodes, group, providerID, legacy)
+
+        return self.iterateGroups(keys, storeGroup,
+                                  "could not publish provider records")
+
+    @defer.inlineCallbacks
+    def _findValueAt(self, nodes, key, semaphore):
+        """
+        Ask the given nodes, the closest first and C{alpha} at a time,
+        for the value stored under C{key}.
+
+        @return: a L{Deferred} that will be called with the value, or
+            with C{None} if none of the nodes has it.
+        """
+        if key in self._dataStore:
+            defer.returnValue(self._dataStore[key])
+        nodes = sorted(nodes, key=lambda contact:
+                       self._routingTable.distance(key, contact.id))
+        for start in xrange(0, len(nodes), constants.alpha):
+            results = yield defer.DeferredList(
+                [semaphore.run(contact.findValue, key)
+                 for contact in nodes[start:start + constants.alpha]],
+                consumeErrors=True)
+            for success, result in results:
+                if success and type(result) == dict and key in result:
+                    defer.returnValue(result[key])
+        defer.returnValue(None)
+
+    def iterativeFindValues(self, keys):
+        """
+        Find the values stored under many keys.
+
+        The keys are grouped by L{iterateGroups}, and every key of a
+        group is asked for at the closest nodes of the group, so that
+        a key costs about one RPC instead of a lookup.  At most
+        C{maxRPCs} of these RPCs are sent at a time.
+
+        @return: a C{dict} that maps every key to a L{Deferred} that
+            will be called with the value as soon as it has been
+            found, or with C{None} if the closest nodes do not have
+            it.
+        """
+        results = dict((key, defer.Deferred()) for key in keys)
+        semaphore = defer.DeferredSemaphore(self.maxRPCs)
+
+        def found(value, key):
+            if not results[key].called:
+                results[key].callback(value)
+
+        def findGroup(nodes, group):
+            ds = list()
+            for key in group:
+                findDeferred = self._findValueAt(nodes, key, semaphore)
+                ds.append(findDeferred.addCallback(found, key))
+            return defer.DeferredList(ds, consumeErrors=True)
+
+        def finished(ignore):
+            # Keys whose group could not be looked up.
+            for key in results:
+                found(None, key)
+
+        groupsDeferred = self.iterateGroups(results.keys(), findGroup,
+                                            "could not look up values")
+        groupsDeferred.addCallback(finished)
+        return results
 
 
 class ResolverPublisher:
     """
+    Resolver and publisher of provider records.
+
+    A chunk is published both as a provider record under its record
+    key, so that resolving it takes a single lookup, and, while
+    C{legacyRecords} is true, in the older list of provider IDs that
+    nodes that predate the records read.  While C{legacyRecords} is
+    true both are read when resolving, so that providers that only
+    write the older list are found too; otherwise the older list is
+    only read for chunks that have no record.
+
     @ivar node: node connected to the DHT
     @type node: C{kademlia.node.Node}
+    @ivar legacyRecords: whether to keep the older lists up to date.
+    @ivar maxLookups: most full lookups that L{resolveMany} runs at the
+        same time.
     """
     implements(idistfs.IResolver, idistfs.IPublisher)
 
+    legacyRecords = True
+    maxLookups = 8
+
     def __init__(self, node):
         self.node = node
 
     def resolve(self, chunkName):
         """
-        Resolve the specified chunk name into a list of contacts where
-        the chunk can be found.
+        Resolve the specified chunk name into a list of locations where
+        the chunk can be found, the most recently published first.
+
+        Providers whose records carry their address are returned as
+        L{Provider}s right away; the others are looked up in the DHT
+        and returned as L{Contact}s.
 
         @return: a L{Deferred} that will be called with a list of
-            L{Contact} objects.
+            locations.
         """
-        h = hashlib.sha1()
-        h.update(chunkName)
-        key = h.digest()
+        key = recordKey(chunkName)
+        legacyKey = util.shadigest(chunkName)
 
-        def getTargetNodes(result):
-            """
-            Convert stored values into contacts.
-            """
+        def mergeRecords((recordResult, legacyResult)):
+            providers = dict()
+            if type(legacyResult) == dict:
+                providers.update(parseProviders(legacyResult[legacyKey]))
+            if type(recordResult) == dict:
+                providers.update(parseProviders(recordResult[key]))
+            return providers
+
+        def getRecords(result):
             if type(result) == dict:
-                return defer.DeferredList(
-                    [self.node.findContact(c) for c in result[key]])
-            return []
+                return parseProviders(result[key])
+            # Only nodes that predate the records have published it,
+            # if anyone.
+            findDeferred = self.node.iterativeFindValue(legacyKey)
+            return findDeferred.addCallback(getProviderIDs)
+
+        def getProviderIDs(result):
+            if type(result) == dict:
+                return parseProviders(result[legacyKey])
+            return dict()
+
+        if self.legacyRecords:
+            completeDeferred = defer.gatherResults(
+                [self.node.iterativeFindValue(key),
+                 self.node.iterativeFindValue(legacyKey)],
+                consumeErrors=True)
+            completeDeferred.addCallback(mergeRecords)
+        else:
+            completeDeferred = self.node.iterativeFindValue(key)
+            completeDeferred.addCallback(getRecords)
+        completeDeferred.addCallback(self._locate)
+        return completeDeferred
 
+    def _locate(self, providers):
+        """
+        Convert provider records into locations.
+        """
         def filterResult(result):
             """
             Filter out not found results.
             """
-            return (c for (s,c) in result if s)
+            return [c for (s, c) in result if s and c is not None]
 
-        completeDeferred = self.node.iterativeFindValue(key)
-        completeDeferred.addCallback(getTargetNodes)
-        completeDeferred.addCallback(filterResult)
-        return completeDeferred
+        records = providers.items()
+        records.sort(key=lambda (providerID, record): -record[2])
+        ds = list()
+        for providerID, (address, port, published) in records:
+            if address:
+                ds.append(defer.succeed(Provider(providerID, address,
+                                                 port, published)))
+            else:
+                ds.append(self.node.findContact(providerID))
+        return defer.DeferredList(ds).addCallback(filterResult)
+
+    def resolveMany(self, chunkNames):
+        """
+        Resolve many chunks at once.
+
+        The provider records of all chunks are looked up with
+        L{OverlayNode.iterativeFindValues}, which shares lookups
+        between chunks whose keys are close, together with the older
+        lists while C{legacyRecords} is true.  Chunks for which nothing
+        is found that way get a full L{resolve}, at most C{maxLookups}
+        at a time.
+
+        @return: a C{dict} that maps every chunk name to a
+            L{Deferred} that will be called with the list of locations
+            as soon as that chunk has been resolved.
+        """
+        chunkNames = set(chunkNames)
+        if not hasattr(self.node, 'iterativeFindValues'):
+            return dict((chunkName, self.resolve(chunkName))
+                        for chunkName in chunkNames)
+        semaphore = defer.DeferredSemaphore(self.maxLookups)
+
+        def cbFind((value, legacyValue), chunkName):
+            if value is None and legacyValue is None:
+                return semaphore.run(self.resolve, chunkName)
+            providers = dict()
+            if legacyValue is not None:
+                providers.update(parseProviders(legacyValue))
+            if value is not None:
+                providers.update(parseProviders(value))
+            return self._locate(providers)
+
+        keys = list()
+        for chunkName in chunkNames:
+            keys.append(recordKey(chunkName))
+            if self.legacyRecords:
+                keys.append(util.shadigest(chunkName))
+        values = self.node.iterativeFindValues(keys)
+        resolved = dict()
+        for chunkName in chunkNames:
+            lookups = [values[recordKey(chunkName)]]
+            if self.legacyRecords:
+                lookups.append(values[util.shadigest(chunkName)])
+            else:
+                lookups.append(defer.succeed(None))
+            findDeferred = defer.gatherResults(lookups, consumeErrors=True)
+            resolved[chunkName] = findDeferred.addCallback(cbFind, chunkName)
+        return resolved
+
+    def publishMany(self, chunkNames):
+        """
+        Publish that all the specified chunks can be found at this
+        node, using as few RPCs as the node allows; see
+        L{OverlayNode.iterativeAddProviders}.
+        """
+        if not hasattr(self.node, 'iterativeAddProviders'):
+            return defer.DeferredList([self._publish(chunkName)
+                                       for chunkName in chunkNames])
+        ds = [self.node.iterativeAddProviders(
+            [recordKey(chunkName) for chunkName in chunkNames])]
+        if self.legacyRecords:
+            ds.append(self.node.iterativeAddProviders(
+                [util.shadigest(chunkName) for chunkName in chunkNames],
+                legacy=True))
+        return defer.DeferredList(ds, fireOnOneErrback=True)
 
     def publish(self, chunkName):
         """
         See IPublisher.publish.
         """
-        key = util.shadigest(chunkName)
+        return self.publishMany([chunkName])
 
-        def store(result, value):
-            index = list()
+    def sortKey(self, chunkName):
+        """
+        Return the key that chunks should be sorted on for
+        L{publishMany} to need the fewest lookups.
+        """
+        return recordKey(chunkName)
+
+    def _update(self, key, update):
+        """
+        Read the value stored under C{key}, change it with C{update}
+        and store it again, unless C{update} returns C{None}.
+        """
+        def store(result):
+            value = list()
             if type(result) == dict:
-                index.extend(result[key])
-            if not value in index:
-                index.append(value)
-            return self.iterativeStore(key, index)
+                value = result[key]
+            value = update(value)
+            if value is None:
+                return None
+            return self.node.iterativeStore(key, value)
 
         # FIXME: is there a public API for this?
         d = self.node._iterativeFind(key, rpc='findValue')
-        return d.addCallback(store, value)
-        
+        return d.addCallback(store)
+
+    def _publish(self, chunkName):
+        providerID = self.node.id
+
+        def addRecord(value):
+            providers = parseProviders(value)
+            if providerID in providers:
+                return None
+            providers[providerID] = ['', self.node.port, int(time.time())]
+            return formatProviders(providers)
+
+        def addProviderID(value):
+            if providerID in value:
+                return None
+            return list(value) + [providerID]
+
+        ds = [self._update(recordKey(chunkName), addRecord)]
+        if self.legacyRecords:
+            ds.append(self._update(util.shadigest(chunkName), addProviderID))
+        return defer.DeferredList(ds, fireOnOneErrback=True)
+
+    def unpublish(self, chunkName):
+        """
+        See IPublisher.unpublish.
+        """
+        providerID = self.node.id
+
+        def removeRecord(value):
+            providers = parseProviders(value)
+            if providerID not in providers:
+                return None
+            del providers[providerID]
+            return formatProviders(providers)
+
+        def removeProviderID(value):
+            if providerID not in value:
+                return None
+            return [v for v in value if v != providerID]
+
+        return defer.DeferredList(
+            [self._update(recordKey(chunkName), removeRecord),
+             self._update(util.shadigest(chunkName), removeProviderID)],
+            fireOnOneErrback=True)
+
+
+class CachingResolver(object):
+    """
+    Resolver that remembers where chunks were found, so that chunks
+    that are read again do not cost another DHT lookup.
+
+    Locations are kept for C{ttl} seconds, the interval at which the
+    DHT replicates its records, and a chunk that could not be found is
+    remembered as such for C{negativeTTL} seconds.  At most
+    C{maxEntries} chunks are kept; the least recently resolved are
+    dropped first.  Resolves of a chunk that is already being looked
+    up wait for that lookup.
+
+    @ivar resolver: the L{IResolver} that looks chunks up.
+    @ivar entries: an C{OrderedDict} that maps chunk names to
+        C{(expires, locations)} tuples, least recently used first.
+    @ivar lookups: a C{dict} that maps chunk names to lists of
+        L{Deferred}s waiting for a lookup that is running.
+    @ivar hits: number of resolves answered from the cache.
+    @ivar misses: number of resolves that needed a lookup.
+    """
+    implements(idistfs.IResolver)
+
+    ttl = constants.replicateInterval
+    negativeTTL = 60
+    maxEntries = 100000
+
+    def __init__(self, resolver, maxEntries=None, clock=time.time):
+        self.resolver = resolver
+        if maxEntries is not None:
+            self.maxEntries = maxEntries
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lookups = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, chunkName):
+        """
+        See IResolver.resolve.
+
+        @return: a L{Deferred} that will be called with a C{list} of
+            locations.
+        """
+        entry = self.entries.pop(chunkName, None)
+        if entry is not None and entry[0] > self.clock():
+            self.entries[chunkName] = entry
+            self.hits += 1
+            return defer.succeed(list(entry[1]))
+
+        waitDeferred = defer.Deferred()
+        if chunkName in self.lookups:
+            self.lookups[chunkName].append(waitDeferred)
+            return waitDeferred
+        self.misses += 1
+        self.lookups[chunkName] = [waitDeferred]
+        resolveDeferred = self.resolver.resolve(chunkName)
+        resolveDeferred.addBoth(self._resolved, chunkName)
+        return waitDeferred
+
+    def resolveMany(self, chunkNames):
+        """
+        Resolve many chunks at once; chunks that are not in the cache
+        are handed to the C{resolveMany} of the resolver, if it has
+        one.
+
+        @return: a C{dict} that maps every chunk name to a
+            L{Deferred} that will be called with the list of locations
+            as soon as that chunk has been resolved.
+        """
+        resolved = dict()
+        misses = list()
+        for chunkName in set(chunkNames):
+            if chunkName in self.lookups:
+                resolved[chunkName] = self.resolve(chunkName)
+                continue
+            entry = self.entries.get(chunkName)
+            if entry is not None and entry[0] > self.clock():
+                resolved[chunkName] = self.resolve(chunkName)
+            else:
+                misses.append(chunkName)
+        if not misses:
+            return resolved
+
+        if hasattr(self.resolver, 'resolveMany'):
+            resolving = self.resolver.resolveMany(misses)
+        else:
+            resolving = dict((chunkName, self.resolver.resolve(chunkName))
+                             for chunkName in misses)
+        for chunkName in misses:
+            self.misses += 1
+            waitDeferred = defer.Deferred()
+            self.lookups[chunkName] = [waitDeferred]
+            resolving[chunkName].addBoth(self._resolved, chunkName)
+            resolved[chunkName] = waitDeferred
+        return resolved
+
+    def _resolved(self, result, chunkName):
+        waiting = self.lookups.pop(chunkName)
+        if not isinstance(result, failure.Failure):
+            result = list(result)
+            self.add(chunkName, result)
+        for waitDeferred in waiting:
+            if isinstance(result, failure.Failure):
+                waitDeferred.errback(result)
+            else:
+                waitDeferred.callback(list(result))
+
+    def add(self, chunkName, locations):
+        """
+        Remember the locations of a chunk, or that it could not be
+        found if C{locations} is empty.
+        """
+        if locations:
+            expires = self.clock() + self.ttl
+        else:
+            expires = self.clock() + self.negativeTTL
+        self.entries.pop(chunkName, None)
+        self.entries[chunkName] = (expires, tuple(locations))
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, chunkName, location=None):
+        """
+        Forget a location of a chunk, for example because it failed
+        to serve the chunk, or all locations if C{location} is
+        C{None}.
+        """
+        entry = self.entries.get(chunkName)
+        if entry is None:
+            return
+        expires, locations = entry
+        if location is not None:
+            key = (location.address, location.port)
+            locations = tuple(l for l in locations
+                              if (l.address, l.port) != key)
+        else:
+            locations = ()
+        if locations:
+            self.entries[chunkName] = (expires, locations)
+        else:
+            # A chunk that has no good locations left must be looked
+            # up again rather than reported missing.
+            del self.entries[chunkName]
@@ -0,0 +1,567 @@
+#
+
+from twisted.internet import defer
+from twisted.python.filepath import FilePath
+from twisted.python import failure
+from distfs.error import NoSuchChunkError
+from distfs.store import PumpIterator, HashingFile, ThreadPump
+from distfs.store import ObservableStore, syncPaths
+from distfs import idistfs, hashing
+from zope.interface import implements
+
+import sqlite3
+import errno
+import time
+import os
+
+"""Storage for chunks of data packed into large segment files.
+"""
+
+
+class _SliceFile(object):
+    """
+    Read-only file-like object for a range of bytes in a file.
+    """
+
+    def __init__(self, file, offset, size):
+        self.file = file
+        self.file.seek(offset)
+        self.remaining = size
+
+    def read(self, size):
+        data = self.file.read(min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+
+class PackStoreFile(HashingFile):
+    """
+    File-like object returned by L{PackStore.store}.
+
+    Data is spooled to a temporary file, since several chunks may be
+    written at the same time but only one of them can be appended to
+    the current segment at a time.  The spooled data is appended to
+    the segment when the file is closed.
+    """
+
+    def __init__(self, store, chunkName, resume=False):
+        self.store = store
+        self.chunkName = chunkName
+        self.spoolPath = store.dir.child('%s.pump' % chunkName)
+        self.algorithm = hashing.chunkAlgorithm(chunkName, store.algorithm)
+        self.written = 0
+        self._reset()
+        if resume and self.spoolPath.exists():
+            self.file = open(self.spoolPath.path, 'r+b')
+            self._rehash()
+        else:
+            self.file = open(self.spoolPath.path, 'w+b')
+
+    def suspend(self):
+        """
+        Close the file without making the chunk available, keeping
+        the spooled data so that it can be resumed.
+        """
+        self.file.close()
+
+    def close(self):
+        """
+        Append the spooled data to the store.
+
+        @return: a L{Deferred} that will be called when the chunk is
+            available in the store.
+        """
+        if not self.written:
+            self.file.close()
+            self.spoolPath.remove()
+            return defer.succeed(None)
+
+        digest = self.digest()
+        self.file.seek(0)
+
+        def cleanup(result):
+            self.file.close()
+            self.spoolPath.remove()
+            return result
+
+        committed = defer.Deferred()
+        appendDeferred = self.store.lock.run(self.store._append,
+                                             self.chunkName, self.file,
+                                             None, digest, committed)
+        appendDeferred.addCallback(lambda ignore: committed)
+        appendDeferred.addBoth(cleanup)
+        return appendDeferred.addCallback(self.store._appended,
+                                          self.chunkName)
+
+
+class SegmentCommitter(object):
+    """
+    Makes chunks that have been appended to the segments of a
+    L{PackStore} durable before they are entered in the index, in
+    batches.
+
+    The segments a batch was written to are synced once each and all
+    chunks of the batch are then entered in the index in a single
+    transaction.  Chunks that are appended while a batch is being
+    synced wait for the next batch.
+
+    @ivar pending: C{(entry, commitDeferred)} tuples waiting for the
+        next batch, where C{entry} holds the arguments for
+        L{PackStore._addEntry}.
+    @ivar batch: the batch that is being synced.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.pending = list()
+        self.batch = list()
+        self.running = False
+
+    def segments(self):
+        """
+        Return the segments that have chunks waiting to be committed.
+        """
+        return set(entry[1] for (entry, d) in self.pending + self.batch)
+
+    def commit(self, entry):
+        """
+        Commit an appended chunk.
+
+        @return: a L{Deferred} that will be called when the chunk is
+            available in the store.
+        """
+        commitDeferred = defer.Deferred()
+        self.pending.append((entry, commitDeferred))
+        if not self.running:
+            self._flush()
+        return commitDeferred
+
+    def _flush(self):
+        self.batch, self.pending = self.pending, list()
+        self.running = True
+        paths = [self.store.segmentPath(segment).path
+                 for segment in set(entry[1] for (entry, d) in self.batch)]
+        syncDeferred = self.store.pumper.call(syncPaths, paths)
+        syncDeferred.addBoth(self._synced)
+
+    def _synced(self, result):
+        batch, self.batch = self.batch, list()
+        try:
+            if isinstance(result, failure.Failure):
+                self.store._abandonEntries([entry for (entry, d) in batch])
+            else:
+                self.store._addEntries([entry for (entry, d) in batch])
+        except:
+            result = failure.Failure()
+
+        self.running = False
+        if self.pending:
+            self._flush()
+        for entry, commitDeferred in batch:
+            if isinstance(result, failure.Failure):
+                commitDeferred.errback(result)
+            else:
+                commitDeferred.callback(None)
+
+
+class PackStore(ObservableStore):
+    """
+    Chunk store that appends chunks to large segment files.
+
+    Every chunk costs a row in the index database rather than two
+    inodes, which makes this store a better fit than
+    L{FileSystemStore} for many small chunks.  Removed chunks leave
+    dead space in their segment which is reclaimed by L{compact}.
+
+    @ivar entries: a C{dict} that maps chunk names to C{(segment,
+        offset, size, digest, mtime)} tuples.
+    @ivar segments: a C{dict} that maps segment numbers to C{[size,
+        dead]} lists, where C{dead} is the number of bytes that belong
+        to removed chunks.
+    @ivar current: number of the segment that chunks are appended to.
+    @ivar lock: L{DeferredLock} that serializes appends and
+        compactions.
+    @ivar committer: L{SegmentCommitter} that syncs appended chunks
+        to disk before they are entered in the index.
+    @ivar observers: L{IStoreObserver}s that are told about chunks
+        that are added or removed.
+
+    @cvar segmentSize: a new segment is started when the current
+        segment grows beyond this size.
+    @cvar compactThreshold: fraction of dead bytes in a segment above
+        which L{compact} rewrites it.
+    @cvar algorithm: hash algorithm that new chunks are hashed with,
+        unless they are named after a digest of another algorithm;
+        see L{distfs.hashing}.
+    @cvar readSize: block size used when appending chunks.
+    @cvar pumpThreads: number of worker threads used to append to
+        and sync segments; appends are serialized by the lock, and a
+        second thread lets the next append run while the committer
+        syncs.
+    @cvar pumpExpiry: age in seconds after which C{.pump} spool files
+        that are no longer written to are removed by
+        L{removeStalePumps}.
+    """
+    implements(idistfs.IStore)
+
+    segmentSize = 256 * 1024 * 1024
+    compactThreshold = 0.5
+    algorithm = hashing.defaultAlgorithm
+    pumpThreads = 2
+    readSize = PumpIterator.readSize
+    pumpExpiry = 24 * 60 * 60
+
+    def __init__(self, dir, algorithm=None):
+        ObservableStore.__init__(self)
+        self.dir = FilePath(dir)
+        if algorithm is not None:
+            hashing.newHash(algorithm)
+            self.algorithm = algorithm
+        self.pumper = ThreadPump(self.pumpThreads)
+        try:
+            self.dir.createDirectory()
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        dbFile = self.dir.child('pack.db').path
+        createDB = not os.path.exists(dbFile)
+        self._db = sqlite3.connect(dbFile)
+        self._db.isolation_level = None
+        self._db.text_factory = str
+        if createDB:
+            self._db.execute('CREATE TABLE chunks(name PRIMARY KEY, segment, '
+                             'offset, size, digest, mtime)')
+            self._db.execute('CREATE TABLE segments(segment PRIMARY KEY, '
+                             'size, dead)')
+
+        self.entries = dict()
+        for row in self._db.execute('SELECT name, segment, offset, size, '
+                                    'digest, mtime FROM chunks'):
+            self.entries[row[0]] = row[1:]
+        self.segments = dict()
+        for segment, size, dead in self._db.execute(
+            'SELECT segment, size, dead FROM segments'):
+            self.segments[segment] = [size, dead]
+        if not self.segments:
+            self._addSegment(0)
+        self.current = max(self.segments)
+        self.lock = defer.DeferredLock()
+        self.committer = SegmentCommitter(self)
+
+    def segmentPath(self, segment):
+        """
+        Return path to the specified segment file.
+
+        @rtype: L{FilePath}
+        """
+        return self.dir.child('segment-%08d.pack' % segment)
+
+    def _addSegment(self, segment):
+        self.segments[segment] = [0, 0]
+        self._db.execute('INSERT INTO segments(segment, size, dead) '
+                         'VALUES (?, 0, 0)', (segment,))
+
+    def _updateSegment(self, segment):
+        size, dead = self.segments[segment]
+        self._db.execute('UPDATE segments SET size=?, dead=? WHERE segment=?',
+                         (size, dead, segment))
+
+    def _removeSegment(self, segment):
+        del self.segments[segment]
+        self._db.execute('DELETE FROM segments WHERE segment=?', (segment,))
+        self.segmentPath(segment).remove()
+
+    def iterChunks(self):
+        """
+        Iterate through all available chunks.
+        """
+        return iter(self.entries.keys())
+
+    def hasChunk(self, chunkName):
+        """
+        Check if the store has the specified chunk.
+        """
+        return chunkName in self.entries
+
+    def __contains__(self, chunkName):
+        return self.hasChunk(chunkName)
+
+    def query(self, chunkName):
+        """
+        Query store for information about the specified chunk.
+
+        The returned path is the path to the segment that holds the
+        chunk; use L{locate} to find the chunk within it.
+
+        @return: a C{tuple} with an absolute path to the segment, the
+            chunk size and its hash digest.
+        """
+        try:
+            segment, offset, size, digest, mtime = self.entries[chunkName]
+        except KeyError:
+            raise NoSuchChunkError(chunkName)
+        return (self.segmentPath(segment).path, size, digest)
+
+    def locate(self, chunkName):
+        """
+        Return a C{tuple} with the path to the segment file that holds
+        the chunk, the offset of the chunk within it and the chunk
+        size.
+        """
+        try:
+            segment, offset, size, digest, mtime = self.entries[chunkName]
+        except KeyError:
+            raise NoSuchChunkError(chunkName)
+        return (self.segmentPath(segment).path, offset, size)
+
+    def _append(self, chunkName, fromFile, mtime=None, digest=None,
+                committed=None, source=None):
+        """
+        Append data from C{fromFile} to the current segment.
+
+        Must be called with the lock held.  The space of the chunk is
+        reserved in the segment as soon as the data has been written,
+        so that the lock can be released before the chunk has been
+        made durable and entered in the index by the committer.
+
+        @param digest: the digest of the data, if already known; the
+            data is hashed while it is copied otherwise.
+        @param committed: a L{Deferred} to call when the chunk has
+            been committed, or C{None} to only return once it has.
+        @param source: the C{(segment, offset)} of the chunk if it is
+            moved by L{compact}; see L{_addEntry}.
+        """
+        size, dead = self.segments[self.current]
+        if size >= self.segmentSize:
+            self.current += 1
+            self._addSegment(self.current)
+            size = 0
+
+        segment = self.current
+        segmentPath = self.segmentPath(segment)
+        try:
+            toFile = open(segmentPath.path,
+                          segmentPath.exists() and 'r+b' or 'w+b')
+            # Anything beyond the recorded size was left behind by an
+            # append that failed and can be overwritten.
+            toFile.truncate(size)
+            toFile.seek(size)
+            iterator = PumpIterator(toFile, fromFile,
+                                    digest is None and
+                                    hashing.chunkAlgorithm(chunkName,
+                                                           self.algorithm)
+                                    or None, self.readSize)
+        except (OSError, IOError), e:
+            return defer.fail(e)
+
+        def cbAppend(iterator):
+            self.segments[segment][0] = size + iterator.written
+            commitDeferred = self.committer.commit(
+                (chunkName, segment, size, iterator.written,
+                 digest or iterator.digest(), mtime, source))
+            if committed is None:
+                return commitDeferred
+            commitDeferred.chainDeferred(committed)
+
+        def ebAppend(reason):
+            toFile.close()
+            return reason
+
+        doneDeferred = self.pumper.run(iterator)
+        return doneDeferred.addCallbacks(cbAppend, ebAppend)
+
+    def _addEntry(self, chunkName, segment, offset, size, digest,
+                  mtime=None, source=None):
+        """
+        Enter a chunk in the index.
+
+        @param source: for a chunk that was moved by L{compact}, the
+            C{(segment, offset)} it was moved from.  If the chunk has
+            been removed or replaced in the meantime, the copy is not
+            entered and its bytes are accounted as dead instead, so
+            that the move does not bring it back.
+        """
+        if (source is not None
+            and self.entries.get(chunkName, (None, None))[:2] != source):
+            self.segments[segment][1] += size
+            self._updateSegment(segment)
+            return
+        if mtime is None:
+            mtime = time.time()
+        if chunkName in self.entries:
+            self._release(chunkName)
+        self.entries[chunkName] = (segment, offset, size, digest, mtime)
+        self.segments[segment][0] = max(self.segments[segment][0],
+                                        offset + size)
+        self._updateSegment(segment)
+        self._db.execute('INSERT OR REPLACE INTO chunks(name, segment, '
+                         'offset, size, digest, mtime) VALUES '
+                         '(?, ?, ?, ?, ?, ?)',
+                         (chunkName, segment, offset, size, digest, mtime))
+
+    def _addEntries(self, entries):
+        """
+        Enter chunks that have been made durable in the index, in a
+        single transaction.
+        """
+        self._db.execute('BEGIN')
+        try:
+            for entry in entries:
+                self._addEntry(*entry)
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _abandonEntries(self, entries):
+        """
+        Account the space of chunks that could not be committed as
+        dead.
+        """
+        for entry in entries:
+            segment, size = entry[1], entry[3]
+            if segment in self.segments:
+                self.segments[segment][1] += size
+                self._updateSegment(segment)
+
+    def _release(self, chunkName):
+        """
+        Drop a chunk from the index and account its bytes as dead.
+        """
+        segment, offset, size, digest, mtime = self.entries.pop(chunkName)
+        self.segments[segment][1] += size
+        self._updateSegment(segment)
+        self._db.execute('DELETE FROM chunks WHERE name=?', (chunkName,))
+
+    def _appended(self, result, chunkName):
+        """
+        Tell the observers about a new chunk.  Chunks that are moved by
+        L{compact} are not new and do not go through here.
+        """
+        self.notifyAdded(chunkName)
+        return result
+
+    def pump(self, chunkName, fromFile):
+        """
+        Create a new chunk in the store by pumping data from the given
+        file.
+
+        @return: a Deferred that will be called when the file has been
+            transfered.
+        """
+        committed = defer.Deferred()
+        appendDeferred = self.lock.run(self._append, chunkName, fromFile,
+                                       committed=committed)
+        appendDeferred.addCallback(lambda ignore: committed)
+        return appendDeferred.addCallback(self._appended, chunkName)
+
+    def store(self, chunkName, resume=False):
+        """
+        Returns a file-like object that is used to write content to
+        the chunk.
+
+        The chunk is not available until the L{Deferred} returned by
+        the C{close} method of the file-like object has been called.
+
+        @param resume: if C{True}, data spooled by an earlier suspended
+            file for the same chunk is kept.
+        """
+        return PackStoreFile(self, chunkName, resume)
+
+    def remove(self, chunkName):
+        """
+        Remove the specified chunk from the store.
+
+        The space it occupied is reclaimed by the next L{compact}.
+        """
+        if chunkName not in self.entries:
+            raise NoSuchChunkError(chunkName)
+        self._release(chunkName)
+        self.notifyRemoved(chunkName)
+
+    def removeStalePumps(self):
+        """
+        Remove C{.pump} spool files that have not been written to for
+        C{pumpExpiry} seconds, such as those of downloads that were
+        given up.
+
+        @return: a L{Deferred} that will be called with the number of
+            removed files.
+        """
+        expires = time.time() - self.pumpExpiry
+        removed = 0
+        for name in os.listdir(self.dir.path):
+            if not name.endswith('.pump'):
+                continue
+            path = self.dir.child(name).path
+            try:
+                if os.path.getmtime(path) < expires:
+                    os.remove(path)
+                    removed += 1
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return defer.succeed(removed)
+
+    @defer.inlineCallbacks
+    def _compactSegment(self, segment):
+        """
+        Copy all live chunks of C{segment} to the current segment and
+        remove it.
+
+        The copies are committed together, and the segment is only
+        removed once all of them have been.
+
+        Must be called with the lock held.
+        """
+        live = [(entry[1], chunkName)
+                for (chunkName, entry) in self.entries.iteritems()
+                if entry[0] == segment]
+        live.sort()
+        commits = list()
+        segmentFile = self.segmentPath(segment).open()
+        try:
+            for offset, chunkName in live:
+                if self.entries.get(chunkName, (None,))[0] != segment:
+                    # removed or replaced while we were copying
+                    continue
+                size, digest, mtime = self.entries[chunkName][2:]
+                committed = defer.Deferred()
+                yield self._append(chunkName,
+                                   _SliceFile(segmentFile, offset, size),
+                                   mtime, digest, committed,
+                                   source=(segment, offset))
+                commits.append(committed)
+        finally:
+            segmentFile.close()
+            # Even if a copy failed, the earlier ones have to be
+            # committed before the lock is released.
+            results = yield defer.DeferredList(commits, consumeErrors=True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
+        self._removeSegment(segment)
+
+    @defer.inlineCallbacks
+    def _compact(self):
+        candidates = list()
+        uncommitted = self.committer.segments()
+        for segment, (size, dead) in self.segments.iteritems():
+            if segment == self.current or not size or segment in uncommitted:
+                continue
+            if float(dead) / size >= self.compactThreshold:
+                candidates.append(segment)
+        for segment in sorted(candidates):
+            yield self._compactSegment(segment)
+        defer.returnValue(len(candidates))
+
+    def compact(self):
+        """
+        Rewrite segments where the fraction of dead bytes has reached
+        C{compactThreshold}.
+
+        @return: a L{Deferred} that will be called with the number of
+            compacted segments.
+        """
+        return self.lock.run(self._compact)
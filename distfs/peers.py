@@ -0,0 +1,196 @@
+#
+
+import random
+import time
+
+"""Bookkeeping of how well other nodes serve us chunks.
+"""
+
+
+class PeerStats(object):
+    """
+    Statistics about transfers from a single peer.
+
+    Round-trip time and bandwidth are exponentially weighted moving
+    averages.  Failures are forgotten gradually, with the count halved
+    every C{failureHalfLife} seconds.
+
+    @ivar rtt: time from sending a request until the response headers
+        arrived, in seconds, or C{None} if not measured yet.
+    @ivar bandwidth: observed body throughput in bytes per second, or
+        C{None} if not measured yet.
+    @ivar failures: decayed number of recent failures.
+    @ivar transfers: total number of successful transfers.
+    @ivar lastUpdate: when the statistics were last updated.
+    """
+
+    weight = 0.3
+    failureHalfLife = 300.0
+
+    def __init__(self):
+        self.rtt = None
+        self.bandwidth = None
+        self.failures = 0.0
+        self.failureTime = 0.0
+        self.transfers = 0
+        self.lastUpdate = 0.0
+
+    def _average(self, current, sample):
+        if current is None:
+            return sample
+        return (1 - self.weight) * current + self.weight * sample
+
+    def recentFailures(self, now):
+        """
+        Return the number of failures, decayed to C{now}.
+        """
+        if not self.failures:
+            return 0.0
+        age = max(now - self.failureTime, 0)
+        return self.failures * 0.5 ** (age / self.failureHalfLife)
+
+    def recordResponse(self, rtt, now):
+        self.rtt = self._average(self.rtt, rtt)
+        self.lastUpdate = now
+
+    def recordTransfer(self, bytes, elapsed, now):
+        if bytes and elapsed > 0:
+            self.bandwidth = self._average(self.bandwidth, bytes / elapsed)
+        self.transfers += 1
+        self.lastUpdate = now
+
+    def recordFailure(self, now):
+        self.failures = self.recentFailures(now) + 1
+        self.failureTime = now
+        self.lastUpdate = now
+
+
+class Transfer(object):
+    """
+    A single request to a peer that is being timed.
+    """
+
+    def __init__(self, table, peer):
+        self.table = table
+        self.peer = peer
+        self.started = table.clock()
+        self.responded = None
+
+    def responseReceived(self):
+        """
+        The response headers have arrived.
+        """
+        self.responded = self.table.clock()
+        self.table.get(self.peer).recordResponse(
+            self.responded - self.started, self.responded)
+
+    def done(self, bytes):
+        """
+        The response body, of C{bytes} bytes, has been received.
+        """
+        now = self.table.clock()
+        self.table.get(self.peer).recordTransfer(
+            bytes, now - (self.responded or self.started), now)
+
+    def failed(self):
+        """
+        The request failed.
+        """
+        self.table.get(self.peer).recordFailure(self.table.clock())
+
+
+class PeerTable(object):
+    """
+    Statistics for all peers that chunks have been fetched from, used
+    to pick the locations that are likely to be fastest.
+
+    Peers are ranked on the expected time to fetch C{referenceSize}
+    bytes from them, doubled for every recent failure.  Peers that
+    have not been measured yet are ranked as the best known peer so
+    that they get a chance, or, if no peer has been measured, as if
+    they had C{nominalBandwidth}.  With probability C{explore} a random
+    candidate is moved to the front so that the statistics of the
+    other peers do not go stale.
+
+    @ivar peers: a C{dict} that maps C{(address, port)} to
+        L{PeerStats}.
+    """
+
+    explore = 0.1
+    referenceSize = 1024 * 1024
+    nominalBandwidth = 1024 * 1024
+
+    def __init__(self, clock=time.time, random=random.random):
+        self.peers = dict()
+        self.clock = clock
+        self.random = random
+
+    def key(self, location):
+        return (location.address, location.port)
+
+    def get(self, peer):
+        """
+        Return statistics for the specified peer, creating them if
+        needed.
+
+        @rtype: L{PeerStats}
+        """
+        try:
+            return self.peers[peer]
+        except KeyError:
+            stats = self.peers[peer] = PeerStats()
+            return stats
+
+    def transfer(self, location):
+        """
+        Start timing a request to the specified location.
+
+        @rtype: L{Transfer}
+        """
+        return Transfer(self, self.key(location))
+
+    def cost(self, peer, now, default):
+        """
+        Return the expected time to fetch C{referenceSize} bytes from
+        the peer.
+        """
+        stats = self.peers.get(peer)
+        if stats is None or stats.bandwidth is None:
+            cost = default
+        else:
+            cost = (stats.rtt or 0) + self.referenceSize / stats.bandwidth
+        if stats is not None:
+            cost *= 2 ** stats.recentFailures(now)
+        return cost
+
+    def rank(self, locations):
+        """
+        Return the given locations ordered from the most to the least
+        promising.
+        """
+        now = self.clock()
+        known = [self.cost(self.key(location), now, None)
+                 for location in locations
+                 if self.key(location) in self.peers
+                 and self.peers[self.key(location)].bandwidth is not None]
+        default = known and min(known) or (
+            float(self.referenceSize) / self.nominalBandwidth)
+        ranked = sorted(locations, key=lambda location:
+                        self.cost(self.key(location), now, default))
+        if len(ranked) > 1 and self.random() < self.explore:
+            ranked.insert(0, ranked.pop(int(self.random() * len(ranked))))
+        return ranked
+
+    def describe(self):
+        """
+        Return the statistics of all peers as a C{list} of C{dict}s.
+        """
+        now = self.clock()
+        result = list()
+        for (address, port), stats in sorted(self.peers.iteritems()):
+            result.append({'address': address, 'port': port,
+                           'rtt': stats.rtt or 0.0,
+                           'bandwidth': stats.bandwidth or 0.0,
+                           'failures': stats.recentFailures(now),
+                           'transfers': stats.transfers})
+        return result
@@ -0,0 +1,191 @@
+#
+
+from twisted.application.service import Service
+from twisted.python import log
+from distfs import idistfs
+from zope.interface import implements
+from collections import deque
+
+"""Announcing the chunks of a store to the overlay.
+"""
+
+
+class PublishService(Service):
+    """
+    Service that keeps the overlay up to date about the chunks in a
+    store.
+
+    New chunks are announced as soon as the store tells about them.
+    All chunks are republished every C{interval} seconds, so that the
+    announcements do not expire, with the republishes of a pass spread
+    evenly over the interval rather than started all at once.  No more
+    than C{maxInFlight} publishes are running at any time; new chunks
+    go before republishes.  Publishers that have a C{sortKey} method
+    get the chunks of a pass in that order, and the chunks that are
+    due are handed to C{publishMany} in batches of up to C{batchSize}
+    chunks, each counting as one publish.
+
+    @ivar store: the store whose chunks are published; the service
+        observes it while it is running.
+    @ivar publisher: the L{IPublisher} that publishes chunks.
+    @ivar fresh: names of new chunks that are waiting to be announced,
+        in order of arrival; C{queued} holds the same names.
+    @ivar cycle: names of the chunks to republish in the current pass.
+    @ivar started: number of chunks of C{cycle} that have been taken
+        care of.
+    @ivar passStarted: when the current pass started.
+    @ivar inFlight: number of publishes that are running.
+    @ivar published: number of successful publishes and batches.
+    @ivar failed: number of failed publishes and batches.
+
+    @cvar interval: seconds between republishes of a chunk; must be
+        well below the time the overlay keeps values for.
+    @cvar startDelay: seconds to wait before the first pass, so that
+        the node has a chance to join the network.
+    @cvar tick: shortest time between two checks for due republishes.
+    @cvar batchSize: most chunks handed to C{publishMany} at a time.
+    """
+    implements(idistfs.IStoreObserver)
+
+    interval = 6 * 60 * 60
+    startDelay = 10
+    tick = 1.0
+    maxInFlight = 16
+    batchSize = 256
+
+    def __init__(self, store, publisher, interval=None, maxInFlight=None,
+                 reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.store = store
+        self.publisher = publisher
+        if interval is not None:
+            self.interval = interval
+        if maxInFlight is not None:
+            self.maxInFlight = maxInFlight
+        self.fresh = deque()
+        self.queued = set()
+        self.cycle = list()
+        self.started = 0
+        self.passStarted = None
+        self.inFlight = 0
+        self.published = 0
+        self.failed = 0
+        self.call = None
+
+    def startService(self):
+        Service.startService(self)
+        self.store.addObserver(self)
+        self._schedule(self.startDelay)
+
+    def stopService(self):
+        Service.stopService(self)
+        self.store.removeObserver(self)
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def _schedule(self, delay):
+        if self.call is not None and self.call.active():
+            if self.call.getTime() <= self.reactor.seconds() + delay:
+                return
+            self.call.cancel()
+        self.call = self.reactor.callLater(delay, self.step)
+
+    def chunkAdded(self, chunkName):
+        """
+        Announce a new chunk as soon as a publish slot is free.
+        """
+        if chunkName not in self.queued:
+            self.queued.add(chunkName)
+            self.fresh.append(chunkName)
+        if self.passStarted is not None:
+            self._fill()
+
+    def chunkRemoved(self, chunkName):
+        if chunkName in self.queued:
+            self.queued.discard(chunkName)
+            self.fresh.remove(chunkName)
+
+    def _startPass(self):
+        self.cycle = sorted(self.store.iterChunks(),
+                            key=getattr(self.publisher, 'sortKey', None))
+        self.started = 0
+        self.passStarted = self.reactor.seconds()
+
+    def _due(self):
+        """
+        Return the number of chunks of the current pass that should
+        have been republished by now.
+        """
+        elapsed = self.reactor.seconds() - self.passStarted
+        if elapsed >= self.interval:
+            return len(self.cycle)
+        return int(len(self.cycle) * elapsed / self.interval)
+
+    def _fill(self):
+        """
+        Start new and due publishes until the in-flight limit is
+        reached.
+        """
+        due = self._due()
+        while self.inFlight < self.maxInFlight:
+            batch = list()
+            while len(batch) < self.batchSize and self.fresh:
+                chunkName = self.fresh.popleft()
+                self.queued.discard(chunkName)
+                batch.append(chunkName)
+            while len(batch) < self.batchSize and self.started < due:
+                chunkName = self.cycle[self.started]
+                self.started += 1
+                if self.store.hasChunk(chunkName):
+                    batch.append(chunkName)
+            if not batch:
+                break
+            self._publish(batch)
+
+    def _publish(self, batch):
+        self.inFlight += 1
+        if len(batch) == 1:
+            publishDeferred = self.publisher.publish(batch[0])
+        else:
+            publishDeferred = self.publisher.publishMany(batch)
+        publishDeferred.addCallbacks(self._published, self._failed,
+                                     errbackArgs=(batch,))
+
+    def _published(self, result):
+        self.inFlight -= 1
+        self.published += 1
+        if self.running:
+            self._fill()
+
+    def _failed(self, reason, batch):
+        self.inFlight -= 1
+        self.failed += 1
+        log.err(reason, "could not publish %s" % ', '.join(batch))
+        if self.running:
+            self._fill()
+
+    def step(self):
+        """
+        Start the republishes that are due and schedule the next
+        check.
+        """
+        self.call = None
+        if self.passStarted is None:
+            self._startPass()
+        elif (self.started >= len(self.cycle)
+              and self.reactor.seconds() >= self.passStarted + self.interval):
+            self._startPass()
+
+        self._fill()
+        if self.started < len(self.cycle):
+            # Wake up when the next chunk is due, but not more often
+            # than every tick.
+            due = self.passStarted + (self.started + 1) * (
+                float(self.interval) / len(self.cycle))
+            self._schedule(max(due - self.reactor.seconds(), self.tick))
+        else:
+            self._schedule(max(self.passStarted + self.interval
+                               - self.reactor.seconds(), self.tick))
@@ -0,0 +1,222 @@
+"""Reading ahead of clients that read files sequentially.
+"""
+
+from twisted.python import log
+
+import math
+import time
+
+
+class _File(object):
+    """
+    What a L{ReadAhead} knows about a file that a client reads.
+
+    @ivar chunkNames: the chunk list of the file.
+    @ivar position: index of the chunk the client asked for last, or
+        C{None} before the first one.
+    @ivar prefetched: index of the first chunk that has not been
+        prefetched.
+    @ivar lastAccess: when the client last asked for a chunk in
+        sequence.
+    @ivar interval: average seconds between two chunks in sequence, or
+        C{None} if not known yet.
+    """
+
+    def __init__(self, chunkNames):
+        self.chunkNames = list(chunkNames)
+        self.position = None
+        self.prefetched = 0
+        self.lastAccess = None
+        self.interval = None
+
+
+class ReadAhead(object):
+    """
+    Read-ahead for the files of one client.
+
+    The client tells about the chunk lists of the files it reads with
+    L{open}.  When it then asks for the chunks of a file in sequence,
+    the chunks after the last one it asked for are retrieved in the
+    background before it gets to them.  Asking for a chunk out of
+    sequence stops the read-ahead of that file until the client reads
+    in sequence again.
+
+    The window, the number of chunks that are read ahead, is the
+    number of chunks the client gets through in the time it takes to
+    fetch one, plus one, so that a fast reader is kept ahead of and a
+    slow one does not fill the store with chunks it will not read for
+    a long time.  No read-ahead is started while the store is more
+    than C{pressureLimit} full, since the chunks would only make the
+    store evict others.
+
+    @ivar store: the store chunks are retrieved to.
+    @ivar prefetch: callable that is called with a list of chunk
+        names to retrieve in the background, and returns a C{dict}
+        that maps each of them to a L{Deferred} that fires when the
+        chunk is in the store.
+    @ivar files: a C{dict} that maps file names to L{_File}s.
+    @ivar index: a C{dict} that maps chunk names to a C{list} of
+        C{(file, position)} tuples, one for every place the chunk has
+        in the files, since a chunk can be repeated within a file and
+        shared between files.
+    @ivar latency: average seconds it takes to prefetch a chunk, or
+        C{None} if not known yet.
+    @ivar paused: number of times read-ahead was held back by the
+        quota of the store.
+
+    @cvar minWindow: fewest chunks to read ahead.
+    @cvar maxWindow: most chunks to read ahead; C{0} disables
+        read-ahead.
+    @cvar pressureLimit: fraction of the quota of the store above
+        which no chunks are read ahead.
+    @cvar weight: weight of a new sample in the averages.
+    """
+
+    minWindow = 2
+    maxWindow = 32
+    pressureLimit = 0.9
+    weight = 0.25
+
+    def __init__(self, store, prefetch, maxWindow=None, clock=time.time):
+        self.store = store
+        self.prefetch = prefetch
+        if maxWindow is not None:
+            self.maxWindow = maxWindow
+        self.clock = clock
+        self.files = dict()
+        self.index = dict()
+        self.latency = None
+        self.paused = 0
+
+    def open(self, fileName, chunkNames):
+        """
+        Start to track reads of the specified file.
+        """
+        self.close(fileName)
+        readFile = self.files[fileName] = _File(chunkNames)
+        for position, chunkName in enumerate(readFile.chunkNames):
+            self.index.setdefault(chunkName, list()).append(
+                (readFile, position))
+
+    def close(self, fileName):
+        """
+        Stop tracking reads of the specified file.
+        """
+        readFile = self.files.pop(fileName, None)
+        if readFile is None:
+            return
+        for chunkName in set(readFile.chunkNames):
+            places = [(otherFile, position) for (otherFile, position)
+                      in self.index.get(chunkName, ())
+                      if otherFile is not readFile]
+            if places:
+                self.index[chunkName] = places
+            else:
+                self.index.pop(chunkName, None)
+
+    def clear(self):
+        """
+        Stop tracking reads of all files.
+        """
+        self.files.clear()
+        self.index.clear()
+
+    def _average(self, average, sample):
+        if average is None:
+            return sample
+        return (1 - self.weight) * average + self.weight * sample
+
+    def window(self, readFile):
+        """
+        Return the number of chunks to read ahead of the specified
+        file.
+        """
+        if self.latency is None or not readFile.interval:
+            return self.minWindow
+        window = int(math.ceil(self.latency / readFile.interval)) + 1
+        return max(self.minWindow, min(window, self.maxWindow))
+
+    def accessed(self, chunkNames):
+        """
+        Account that the client asked for the specified chunks, in
+        that order, and read ahead of the files it reads in sequence.
+        """
+        if not self.maxWindow:
+            return
+        now = self.clock()
+        requested = set(chunkNames)
+        touched = list()
+        for chunkName in chunkNames:
+            positions = dict()
+            for readFile, position in self.index.get(chunkName, ()):
+                positions.setdefault(readFile, list()).append(position)
+            for readFile, candidates in positions.iteritems():
+                self._accessFile(readFile, candidates, now)
+                if (readFile.lastAccess is not None
+                    and readFile not in touched):
+                    touched.append(readFile)
+
+        wanted = list()
+        for readFile in touched:
+            start = max(readFile.prefetched, readFile.position + 1)
+            end = min(readFile.position + 1 + self.window(readFile),
+                      len(readFile.chunkNames))
+            if start >= end:
+                continue
+            if self.underPressure():
+                self.paused += 1
+                continue
+            for chunkName in readFile.chunkNames[start:end]:
+                if (chunkName not in wanted
+                    and chunkName not in requested
+                    and not self.store.hasChunk(chunkName)):
+                    wanted.append(chunkName)
+            readFile.prefetched = end
+        if wanted:
+            self._prefetch(wanted)
+
+    def _accessFile(self, readFile, candidates, now):
+        """
+        Account that the client asked for a chunk that is at the given
+        positions in a file.
+        """
+        if (readFile.position is not None
+            and readFile.position + 1 in candidates):
+            position = readFile.position + 1
+            if readFile.lastAccess is not None:
+                readFile.interval = self._average(
+                    readFile.interval, now - readFile.lastAccess)
+            readFile.lastAccess = now
+        elif 0 in candidates:
+            position = 0
+            readFile.lastAccess = now
+            readFile.prefetched = 1
+        else:
+            # Out of sequence; no read-ahead until the client reads in
+            # sequence again.
+            position = min(candidates)
+            readFile.lastAccess = None
+            readFile.prefetched = position + 1
+        readFile.position = position
+
+    def underPressure(self):
+        """
+        Return C{True} if the store is too full to read ahead.
+        """
+        pressure = getattr(self.store, 'pressure', None)
+        return pressure is not None and pressure() > self.pressureLimit
+
+    def _prefetch(self, chunkNames):
+        started = self.clock()
+        prefetching = self.prefetch(chunkNames)
+        for chunkName, prefetchDeferred in prefetching.iteritems():
+            prefetchDeferred.addCallbacks(self._prefetched, self._failed,
+                                          callbackArgs=(started,),
+                                          errbackArgs=(chunkName,))
+
+    def _prefetched(self, result, started):
+        self.latency = self._average(self.latency, self.clock() - started)
+
+    def _failed(self, reason, chunkName):
+        log.msg("could not read ahead %s: %s"
+                % (chunkName, reason.getErrorMessage()))
@@ -5,12 +5,16 @@ from twisted.python.filepath import FilePath
 from twisted.python.util import getPassword
 from twisted.internet.protocol import ClientCreator
 from twisted.internet import reactor, defer, error, task
-from entangled.kademlia.node import Node as KademliaNode
 from entangled.kademlia.datastore import SQLiteDataStore
 from distfs.central import connectDirectoryService
-from distfs.store import FileSystemStore, publishChunks
+from distfs.store import FileSystemStore, migrateFlatStore
+from distfs.store import openStore, storeFormats
+from distfs.hashing import algorithms, defaultAlgorithm
+from distfs.capacity import BoundedStore, evictionPolicies, parseSize
+from distfs.scrub import Scrubber
+from distfs.publish import PublishService
 from distfs.util import daemonize
-from distfs.overlay import ResolverPublisher
+from distfs.overlay import ResolverPublisher, OverlayNode, CachingResolver
 from distfs import server, control
 from twisted.web.server import Site
 
@@ -82,11 +86,118 @@ class Disconnect(AgentCommand):
         return d
     
 
+class Peers(AgentCommand):
+    synopsys = "SERVICE"
+
+    def parseArgs(self, service):
+        self.service = service
+
+    def cbStatistics(self, response):
+        """
+        Print the peer statistics of the service agent.
+        """
+        print "%-21s %9s %12s %8s %9s" % ('PEER', 'RTT (ms)', 'BW (KiB/s)',
+                                         'FAILURES', 'TRANSFERS')
+        for peer in response['peers']:
+            print "%-21s %9.1f %12.1f %8.1f %9d" % (
+                '%s:%d' % (peer['address'], peer['port']),
+                peer['rtt'] * 1000, peer['bandwidth'] / 1024,
+                peer['failures'], peer['transfers'])
+
+    def cbConnect(self, protocol):
+        d = protocol.callRemote(control.PeerStatistics)
+        return d.addCallback(self.cbStatistics)
+
+    def ebConnect(self, reason):
+        print "%s: %s: no such service" % (sys.argv[0], self.service)
+
+    def run(self):
+        """
+        Execute command.
+        """
+        d = self.getCtrl(self.service)
+        d.addCallbacks(self.cbConnect, self.ebConnect)
+        return d
+
+
+class Pin(AgentCommand):
+    synopsys = "SERVICE CHUNK..."
+
+    optFlags = (
+        ('unpin', 'u', 'Allow the chunks to be evicted again'),
+        )
+
+    def parseArgs(self, service, *chunkNames):
+        self.service = service
+        self.chunkNames = chunkNames
+
+    def cbConnect(self, protocol):
+        chunks = [{'chunkName': chunkName} for chunkName in self.chunkNames]
+        return protocol.callRemote(control.Pin, chunks=chunks,
+                                   pinned=not self['unpin'])
+
+    def ebConnect(self, reason):
+        print "%s: %s: no such service" % (sys.argv[0], self.service)
+
+    def run(self):
+        """
+        Execute command.
+        """
+        d = self.getCtrl(self.service)
+        d.addCallbacks(self.cbConnect, self.ebConnect)
+        return d
+
+
+def checkStoreOptions(options):
+    """
+    Check and convert the store options shared by L{Connect} and the
+    store-node plugin.
+
+    @raise usage.UsageError: if an option is invalid.
+    """
+    if options['store-format'] not in storeFormats:
+        raise usage.UsageError("unknown store format: %s"
+                               % options['store-format'])
+    if options['hash'] is not None and options['hash'] not in algorithms:
+        raise usage.UsageError("unknown hash algorithm: %s"
+                               % options['hash'])
+    if options['read-size'] not in (None, 'auto'):
+        try:
+            options['read-size'] = int(options['read-size'])
+        except ValueError:
+            raise usage.UsageError("invalid read size: %s"
+                                   % options['read-size'])
+        if options['read-size'] < 1:
+            raise usage.UsageError("read size must be positive: %d"
+                                   % options['read-size'])
+    if options['max-store-size'] is not None:
+        try:
+            options['max-store-size'] = parseSize(options['max-store-size'])
+        except ValueError:
+            raise usage.UsageError("invalid store size: %s"
+                                   % options['max-store-size'])
+    if options['max-chunks'] is not None:
+        try:
+            options['max-chunks'] = int(options['max-chunks'])
+        except ValueError:
+            raise usage.UsageError("invalid number of chunks: %s"
+                                   % options['max-chunks'])
+    if options['eviction'] not in evictionPolicies:
+        raise usage.UsageError("unknown eviction policy: %s"
+                               % options['eviction'])
+    try:
+        options['scrub-rate'] = parseSize(options['scrub-rate'])
+    except ValueError:
+        raise usage.UsageError("invalid scrub rate: %s"
+                               % options['scrub-rate'])
+
+
 class Connect(usage.Options):
 
     optFlags = (
         ('no-daemon', 'n', 'Do not daemonize'),
         ('logging', 'l', 'Start logging'),
+        ('no-sendfile', None, 'Do not serve chunks with sendfile'),
         )
 
     optParameters = (
@@ -95,10 +206,30 @@ class Connect(usage.Options):
         ('port', 'p', None, 'Port that the server listens on'),
         ('service', 's', None, 'service name'),
         ('introducer', 'i', None, 'Overlay introducer address'),
+        ('store-format', 'f', 'fs',
+         'Chunk store format: fs (file per chunk) or pack (segment files)'),
+        ('hash', None, None,
+         'Hash algorithm for new chunks (default: %s)' % defaultAlgorithm),
+        ('read-size', None, None,
+         'Block size for pumping chunks, in bytes, or "auto" to measure'),
+        ('max-store-size', None, None,
+         'Store quota in bytes; K, M, G and T suffixes are allowed'),
+        ('max-chunks', None, None, 'Maximum number of chunks in the store'),
+        ('eviction', None, 'lru', 'Eviction policy: lru or lfu'),
+        ('scrub-rate', None, '4M',
+         'Bytes per second to re-verify stored chunks at; 0 disables'),
+        ('read-ahead', None, 32,
+         'Most chunks to read ahead of sequential readers; 0 disables'),
         )
 
     def parseArgs(self, location):
         self.location = location
+        checkStoreOptions(self)
+        try:
+            self['read-ahead'] = int(self['read-ahead'])
+        except ValueError:
+            raise usage.UsageError("invalid read-ahead: %s"
+                                   % self['read-ahead'])
 
     def cbConnect(self, directoryService):
         """
@@ -110,8 +241,19 @@ class Connect(usage.Options):
         if not basepath.exists():
             basepath.createDirectory()
 
-        store = FileSystemStore(basepath.child('store').path)
-        chunkFactory = Site(server.StoreResource(store))
+        store = openStore(basepath.child('store').path, self['store-format'],
+                          self['hash'], self['read-size'])
+        # Keep the store within its quota by evicting chunks that
+        # were downloaded from other nodes.
+        if (self['max-store-size'] is not None
+            or self['max-chunks'] is not None):
+            store = BoundedStore(store, self['max-store-size'],
+                                 self['max-chunks'], self['eviction'])
+            store.evict()
+            flushing = task.LoopingCall(store.flush)
+            flushing.start(60, False)
+        chunkFactory = Site(server.StoreResource(store,
+                                                not self['no-sendfile']))
 
         locname = self['alias'] or directoryService.service
 
@@ -121,26 +263,54 @@ class Connect(usage.Options):
         listeningPort = reactor.listenTCP(port, chunkFactory)
 
         keyStore = SQLiteDataStore(basepath.child('%s.db' % locname).path)
-        dhtNode = KademliaNode(listeningPort.getHost().port, keyStore,
-                               reactor=reactor)
+        dhtNode = OverlayNode(listeningPort.getHost().port, keyStore,
+                              reactor=reactor)
         
         # Listen locally so that applications can easily access the
-        # store.
+        # store.  Chunks put here are this node's own and are never
+        # evicted.
+        localFactory = Site(server.StoreResource(store,
+                                                not self['no-sendfile'],
+                                                origin=True))
         reactor.listenUNIX(basepath.child('%s.http' % locname).path,
-                           chunkFactory)
+                           localFactory)
 
         resolverPublisher = ResolverPublisher(dhtNode)
         
+        # Remember where chunks were found so that reading the same
+        # files again does not go to the DHT.
+        resolver = CachingResolver(resolverPublisher)
         controlFactory = control.ControlFactory(store, directoryService,
-                                                dhtNode, resolverPublisher)
+                                                dhtNode, resolver,
+                                                self['read-ahead'])
         reactor.listenUNIX(basepath.child('%s.ctrl' % locname).path,
                            controlFactory)
 
-        # Start a looping call that will publish chunks to the
-        # overlay; do that every 6th hour.  Delay the procedure a bit
-        # so that the node has a chance to join the network.
-        looping = task.LoopingCall(publishChunks, store, resolverPublisher)
-        reactor.callLater(10, looping.start, 6*60*60, True)
+        # Announce new chunks to the overlay as they arrive and
+        # republish the whole store, a little at a time, every 6th
+        # hour.
+        publishing = PublishService(store, resolverPublisher)
+        publishing.startService()
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      publishing.stopService)
+
+        # Pack stores need to be compacted now and then to reclaim
+        # space left behind by removed chunks.
+        if hasattr(store, 'compact'):
+            compacting = task.LoopingCall(store.compact)
+            compacting.start(60*60, False)
+
+        # Clean out data of downloads that were given up, once a day.
+        if hasattr(store, 'removeStalePumps'):
+            sweeping = task.LoopingCall(store.removeStalePumps)
+            sweeping.start(24*60*60, True)
+
+        # Re-verify stored chunks in the background.
+        if self['scrub-rate']:
+            scrubber = Scrubber(store, resolverPublisher, self['scrub-rate'])
+            scrubber.startService()
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                          scrubber.stopService)
 
         # Try joining the network.
         introducers = list()
@@ -184,11 +354,31 @@ class Connect(usage.Options):
         reactor.run()
 
 
+class MigrateStore(usage.Options):
+    synopsis = "[DIR]"
+
+    def parseArgs(self, dir='~/.distfs/store'):
+        self.dir = dir
+
+    def postOptions(self):
+        """
+        Move chunks of a store that uses the old flat layout into
+        fan-out directories.
+        """
+        store = FileSystemStore(os.path.expanduser(self.dir))
+        count = migrateFlatStore(store)
+        print "%s: migrated %d chunks" % (sys.argv[0], count)
+
+
 class Options(usage.Options):
 
     subCommands = (
         ('connect', None, Connect, 'Connect to remote filesysem'),
         ('disconnect', None, Disconnect, 'Disconnect service'),
+        ('peers', None, Peers, 'Show peer statistics of a service'),
+        ('pin', None, Pin, 'Protect chunks from eviction'),
+        ('migrate-store', None, MigrateStore,
+         'Migrate a flat chunk store to the fan-out layout'),
         )
 
 
@@ -0,0 +1,327 @@
+#
+
+from twisted.application.service import Service
+from twisted.python import log
+from distfs.error import NoSuchChunkError
+from distfs.store import ThreadPump
+from distfs import hashing
+
+import sqlite3
+import errno
+import os
+
+"""Background verification of the chunks in a store.
+"""
+
+
+class Scrubber(Service):
+    """
+    Service that walks through the chunks of a store, reads them back
+    and checks that they still have the content they were stored
+    with.
+
+    The first time a chunk is scrubbed its digest is computed and
+    compared with the one the store recorded, and a fast checksum is
+    recorded alongside; later passes only compare the checksum (see
+    L{hashing.Checksum}).  A chunk that does not match is moved to the
+    C{quarantine} directory of the store, removed from the store and
+    unpublished from the overlay.
+
+    Chunks are scrubbed in the order of their names, one block at a
+    time, with the blocks spaced so that no more than C{rate} bytes
+    are read per second.  Blocks are read and hashed in a worker
+    thread of the store, so that the reactor is not held up by the
+    disk.  A chunk that can not be opened is skipped and one that can
+    not be read because of an I/O error is quarantined; either way
+    the scrubber goes on with the next chunk.  The name of the last scrubbed chunk
+    and the recorded checksums are written to C{scrub.db} in the store
+    directory every C{checkpointInterval} chunks, and when the service
+    is stopped, so that a restart continues where the last run
+    stopped.
+
+    @ivar store: the store to scrub.
+    @ivar publisher: an L{IPublisher} to unpublish bad chunks from, or
+        C{None}.
+    @ivar position: name of the last chunk that was scrubbed in the
+        current pass, C{''} at the start of a pass.
+    @ivar checksums: a C{dict} that maps chunk names to their recorded
+        checksums.
+    @ivar quarantined: number of bad chunks found since the service
+        was started.
+    @ivar pumper: L{ThreadPump} that blocks are read in.
+    @ivar reading: L{Deferred} of the block that is being read, or
+        C{None}.
+    """
+
+    rate = 4 * 1024 * 1024
+    blockSize = 128 * 1024
+    passInterval = 24 * 60 * 60
+    checkpointInterval = 100
+
+    def __init__(self, store, publisher=None, rate=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.store = store
+        self.publisher = publisher
+        if rate is not None:
+            self.rate = rate
+        self.call = None
+        self.current = None
+        self.pending = list()
+        self.quarantined = 0
+        self.dirty = dict()
+        self.unsaved = 0
+        self.pumper = getattr(store, 'pumper', None) or ThreadPump(1)
+        self.reading = None
+
+        dbFile = store.dir.child('scrub.db').path
+        createDB = not os.path.exists(dbFile)
+        self._db = sqlite3.connect(dbFile)
+        self._db.isolation_level = None
+        self._db.text_factory = str
+        if createDB:
+            self._db.execute('CREATE TABLE checksums(name PRIMARY KEY, '
+                             'checksum)')
+            self._db.execute('CREATE TABLE state(key PRIMARY KEY, value)')
+        self.checksums = dict(self._db.execute(
+            'SELECT name, checksum FROM checksums'))
+        state = dict(self._db.execute('SELECT key, value FROM state'))
+        self.position = state.get('position', '')
+
+    def startService(self):
+        Service.startService(self)
+        self._schedule(0)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        if self.reading is None:
+            # Otherwise the file is closed when the block has been
+            # read.
+            self._closeCurrent()
+        self.checkpoint()
+
+    def _schedule(self, delay):
+        self.call = self.reactor.callLater(delay, self.step)
+
+    def checkpoint(self):
+        """
+        Write the position and the changed checksums to the database.
+        """
+        self._db.execute('BEGIN')
+        for chunkName, checksum in self.dirty.iteritems():
+            if checksum is None:
+                self._db.execute('DELETE FROM checksums WHERE name=?',
+                                 (chunkName,))
+            else:
+                self._db.execute('INSERT OR REPLACE INTO checksums(name, '
+                                 'checksum) VALUES (?, ?)',
+                                 (chunkName, checksum))
+        self._db.execute('INSERT OR REPLACE INTO state(key, value) '
+                         'VALUES (?, ?)', ('position', self.position))
+        self._db.execute('COMMIT')
+        self.dirty = dict()
+        self.unsaved = 0
+
+    def _setChecksum(self, chunkName, checksum):
+        if checksum is None:
+            self.checksums.pop(chunkName, None)
+        else:
+            self.checksums[chunkName] = checksum
+        self.dirty[chunkName] = checksum
+
+    def _startPass(self):
+        """
+        Collect the chunks that are left to scrub in this pass.
+        """
+        self.pending = sorted((chunkName
+                               for chunkName in self.store.iterChunks()
+                               if chunkName > self.position), reverse=True)
+
+    def _endPass(self):
+        """
+        Forget checksums of chunks that are gone and start over.
+        """
+        for chunkName in self.checksums.keys():
+            if not self.store.hasChunk(chunkName):
+                self._setChecksum(chunkName, None)
+        self.position = ''
+        self.checkpoint()
+
+    def _openNext(self):
+        """
+        Start to scrub the next chunk.
+
+        @return: C{False} if the pass is complete.
+        """
+        # Scrubbing should not count as use of the chunks for a
+        # store that evicts the least used chunks.
+        store = getattr(self.store, 'backend', self.store)
+        while self.pending:
+            chunkName = self.pending.pop()
+            try:
+                digest = store.query(chunkName)[2]
+                path, offset, size = self.store.locate(chunkName)
+                chunkFile = open(path, 'rb')
+                chunkFile.seek(offset)
+            except NoSuchChunkError:
+                continue
+            except (OSError, IOError), e:
+                if e.errno != errno.ENOENT:
+                    log.err(None, "could not open %s for scrubbing"
+                            % chunkName)
+                continue
+            except Exception:
+                log.err(None, "could not open %s for scrubbing" % chunkName)
+                continue
+
+            recorded = self.checksums.get(chunkName)
+            algorithm = hashing.parseDigest(digest)[0]
+            hash = None
+            if (recorded is None
+                or not recorded.startswith(hashing.Checksum.name + ':')):
+                recorded = None
+                if algorithm in hashing.algorithms:
+                    hash = hashing.newHash(algorithm)
+            self.current = [chunkName, chunkFile, size, digest, recorded,
+                            hash, hashing.Checksum()]
+            return True
+        return False
+
+    def _closeCurrent(self):
+        if self.current is not None:
+            self.current[1].close()
+            self.current = None
+
+    def step(self):
+        """
+        Start to scrub the next block.
+        """
+        self.call = None
+        if self.reading is not None:
+            return
+        if self.current is None:
+            if not self.pending:
+                self._startPass()
+            if not self._openNext():
+                self._endPass()
+                self._schedule(self.passInterval)
+                return
+
+        self.reading = self.pumper.call(self._readBlock, self.current)
+        self.reading.addCallbacks(self._blockRead, self._readFailed)
+
+    def _readBlock(self, current):
+        """
+        Read and hash the next block of a chunk.  Runs in a worker
+        thread.
+
+        @return: the number of bytes read.
+        """
+        chunkName, chunkFile, remaining, digest, recorded, hash, checksum = \
+            current
+        data = chunkFile.read(min(self.blockSize, remaining))
+        if hash is not None:
+            hash.update(data)
+        checksum.update(data)
+        return len(data)
+
+    def _blockRead(self, count):
+        self.reading = None
+        if not self.running:
+            self._closeCurrent()
+            return
+        chunkName, chunkFile, remaining, digest, recorded, hash, checksum = \
+            self.current
+        self.current[2] -= count
+        if count and self.current[2]:
+            self._schedule(float(count) / self.rate)
+            return
+
+        self._closeCurrent()
+        if not count and remaining:
+            # The file is shorter than the store says.
+            good = False
+        elif recorded is not None:
+            good = checksum.hexdigest() == recorded
+        elif hash is not None:
+            good = hashing.formatDigest(hashing.parseDigest(digest)[0],
+                                        hash.hexdigest()) == digest
+        else:
+            good = True
+        if good:
+            self._setChecksum(chunkName, checksum.hexdigest())
+        else:
+            self._quarantine(chunkName)
+        self._scrubbed(chunkName, float(count) / self.rate)
+
+    def _readFailed(self, reason):
+        self.reading = None
+        chunkName = self.current[0]
+        self._closeCurrent()
+        log.err(reason, "could not read %s for scrubbing" % chunkName)
+        if not self.running:
+            return
+        if reason.check(IOError, OSError) and reason.value.errno == errno.EIO:
+            self._quarantine(chunkName)
+        self._scrubbed(chunkName, 0)
+
+    def _scrubbed(self, chunkName, delay):
+        """
+        Move on to the next chunk after C{delay} seconds.
+        """
+        self.position = chunkName
+        self.unsaved += 1
+        self._schedule(delay)
+        if self.unsaved >= self.checkpointInterval:
+            try:
+                self.checkpoint()
+            except Exception:
+                log.err(None, "could not save the scrub position")
+
+    def _quarantine(self, chunkName):
+        try:
+            self.quarantine(chunkName)
+        except Exception:
+            log.err(None, "could not quarantine %s" % chunkName)
+
+    def quarantine(self, chunkName):
+        """
+        Move a chunk that failed verification out of the store and
+        withdraw it from the overlay.
+        """
+        log.msg("chunk %s is damaged; moving it to quarantine" % chunkName)
+        self.quarantined += 1
+        quarantineDir = self.store.dir.child('quarantine')
+        try:
+            if not quarantineDir.exists():
+                quarantineDir.createDirectory()
+            path, offset, size = self.store.locate(chunkName)
+            fromFile = open(path, 'rb')
+            toFile = quarantineDir.child(chunkName).open('w')
+            try:
+                fromFile.seek(offset)
+                while size > 0:
+                    data = fromFile.read(min(self.blockSize, size))
+                    if not data:
+                        break
+                    toFile.write(data)
+                    size -= len(data)
+            finally:
+                fromFile.close()
+                toFile.close()
+        except (OSError, IOError, NoSuchChunkError):
+            log.err(None, "could not copy %s to quarantine" % chunkName)
+
+        try:
+            self.store.remove(chunkName)
+        except NoSuchChunkError:
+            pass
+        self._setChecksum(chunkName, None)
+        if self.publisher is not None:
+            unpublishDeferred = self.publisher.unpublish(chunkName)
+            unpublishDeferred.addErrback(log.err,
+                                         "could not unpublish %s" % chunkName)
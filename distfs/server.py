@@ -1,7 +1,23 @@
 from twisted.web.resource import Resource
-#from twisted.web.static import NoRangeStaticProducer
 from twisted.web import http, server
-from twisted.web.error import NoResource, ErrorPage
+try:
+    from twisted.web.resource import NoResource, ErrorPage
+except ImportError:
+    from twisted.web.error import NoResource, ErrorPage
+from twisted.internet.interfaces import IPullProducer, ISSLTransport
+from twisted.internet import abstract
+from zope.interface import implements
+
+import random
+import errno
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
 
 
 class ConflictResource(ErrorPage):
@@ -14,6 +30,215 @@ class ConflictResource(ErrorPage):
 
 
 
+class ChunkProducer(object):
+    """
+    Pull producer that writes a range of bytes from a file to a
+    request and finishes the request when done.
+
+    @ivar request: The request to write the chunk to.
+    @ivar fileObject: The file that holds the chunk.
+    @ivar offset: Offset of the first byte to write.
+    @ivar remaining: Number of bytes left to write.
+    """
+    implements(IPullProducer)
+
+    bufferSize = abstract.FileDescriptor.bufferSize
+
+    def __init__(self, request, fileObject, offset, size):
+        self.request = request
+        self.fileObject = fileObject
+        self.offset = offset
+        self.remaining = size
+
+    def start(self):
+        self.fileObject.seek(self.offset)
+        self.request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self.request:
+            return
+        data = ''
+        if self.remaining:
+            data = self.fileObject.read(min(self.bufferSize, self.remaining))
+        if data:
+            self.remaining -= len(data)
+            # this .write will spin the reactor, calling .doWrite and
+            # then .resumeProducing again, so be prepared for a
+            # re-entrant call
+            self.request.write(data)
+        else:
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.stopProducing()
+
+    def stopProducing(self):
+        self.fileObject.close()
+        self.request = None
+
+
+class MultipleRangeProducer(ChunkProducer):
+    """
+    Pull producer that writes several byte ranges of a file to a
+    request, each preceded by its part header.
+
+    @ivar parts: a C{list} of C{(header, offset, size)} tuples that is
+        consumed as the parts are written.
+    @ivar trailer: data to write after the last part.
+    """
+
+    def __init__(self, request, fileObject, parts, trailer):
+        ChunkProducer.__init__(self, request, fileObject, 0, 0)
+        self.parts = list(parts)
+        self.trailer = trailer
+
+    def start(self):
+        self.request.registerProducer(self, False)
+
+    def nextPart(self):
+        """
+        Position the file at the next part and return its header, or
+        the trailer when all parts have been written.
+        """
+        if not self.parts:
+            trailer, self.trailer = self.trailer, ''
+            return trailer
+        header, self.offset, self.remaining = self.parts.pop(0)
+        self.fileObject.seek(self.offset)
+        return header
+
+    def resumeProducing(self):
+        if not self.request:
+            return
+        if not self.remaining:
+            data = self.nextPart()
+            if data:
+                self.request.write(data)
+                return
+        ChunkProducer.resumeProducing(self)
+
+
+class SendfileProducer(ChunkProducer):
+    """
+    Pull producer that lets the kernel copy a range of bytes from a
+    file straight to the socket of the request using C{sendfile}.
+
+    The producer must be registered with the transport itself (rather
+    than with some wrapper) since it relies on the transport asking
+    for more data only when its own buffer has been flushed, which
+    makes it safe to bypass the buffer.
+    """
+
+    starting = False
+
+    def start(self):
+        # Make the request write out its headers; they end up in the
+        # write buffer of the transport which will call
+        # resumeProducing when the buffer has been flushed.
+        self.request.write('')
+        self.transport = self.request.transport
+        self.starting = True
+        try:
+            self.request.registerProducer(self, False)
+        finally:
+            self.starting = False
+
+    def resumeProducing(self):
+        if not self.request or self.starting:
+            return
+        if not self.remaining:
+            self.request.unregisterProducer()
+            self.request.finish()
+            self.stopProducing()
+            return
+        try:
+            sent = sendfile(self.transport.getHandle().fileno(),
+                            self.fileObject.fileno(), self.offset,
+                            min(self.remaining, self.bufferSize))
+        except (OSError, IOError), e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.transport.loseConnection()
+                self.stopProducing()
+                return
+            sent = 0
+        self.offset += sent
+        self.remaining -= sent
+        # Ask the reactor to tell the transport when the socket is
+        # writable again; the transport then finds its buffer empty
+        # and calls us back.
+        self.transport.startWriting()
+
+
+def canSendfile(request):
+    """
+    Return C{True} if the response body of C{request} can be written
+    with L{SendfileProducer}.
+    """
+    if sendfile is None:
+        return False
+    transport = request.transport
+    if ISSLTransport.providedBy(transport):
+        return False
+    if not (hasattr(transport, 'getHandle')
+            and hasattr(transport, 'startWriting')):
+        return False
+    # Some versions of twisted.web keep a producer of their own
+    # registered with the transport; then it is not ours to drive.
+    return getattr(transport, 'producer', None) is None
+
+
+def parseRange(header, size):
+    """
+    Parse the value of a I{Range} header.
+
+    @param size: size of the entity the ranges refer to.
+    @return: a sorted C{list} of C{(start, end)} tuples with inclusive
+        byte positions, with overlapping and adjacent ranges merged
+        and unsatisfiable ranges left out; or C{None} if the header
+        can not be parsed, in which case it should be ignored.
+    """
+    unit, sep, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs.strip():
+        return None
+    ranges = list()
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        try:
+            if not first.strip():
+                # suffix range; the last N bytes
+                length = int(last)
+                if length < 0:
+                    return None
+                if not length:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(first)
+                if start < 0:
+                    return None
+                end = size - 1
+                if last.strip():
+                    if int(last) < start:
+                        return None
+                    end = min(int(last), end)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    ranges.sort()
+    merged = list()
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
 class ChunkResource(Resource):
     """
     Web resource for a specific chunk.
@@ -24,15 +249,25 @@ class ChunkResource(Resource):
     @ivar chunkName: The name of the chunk.
     @type chunkName: C{str}
 
+    @ivar useSendfile: C{True} if chunks should be written to the
+        socket with C{sendfile} when possible.
+    @type useSendfile: C{bool}
+
+    @ivar origin: C{True} if chunks that are put come from this node
+        rather than from other nodes; see L{StoreResource}.
+    @type origin: C{bool}
+
     @cvar isLeaf: C{True} since a chunk can not have any children.
     """
     isLeaf = True
 
-    def __init__(self, store, chunkName):
+    def __init__(self, store, chunkName, useSendfile=True, origin=False):
         """
         """
         self.store = store
         self.chunkName = chunkName
+        self.useSendfile = useSendfile
+        self.origin = origin
 
     def cbDone(self, deferResult, request):
         """
@@ -44,38 +279,109 @@ class ChunkResource(Resource):
         Render a GET request.
         """
         abspath, size, digest = self.store.query(self.chunkName)
+        abspath, offset, size = self.store.locate(self.chunkName)
+        etag = '"%s"' % digest
 
         # update the request header with information needed for it to
         # render the response.
-        try:
-            contentFile = open(abspath, 'r')
-        except (OSError, IOError), e:
-            request.setResponseCode(500)
+        if request.setETag(etag) == http.CACHED:
             return ''
 
-        if request.setETag(digest) == http.CACHED:
+        request.setHeader('accept-ranges', 'bytes')
+        request.setHeader('content-type', 'application/octet-stream')
+
+        ranges = None
+        rangeHeader = request.getHeader('range')
+        if rangeHeader is not None and self.checkIfRange(request, etag):
+            ranges = parseRange(rangeHeader, size)
+        if ranges is not None and not ranges:
+            request.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            request.setHeader('content-range', 'bytes */%d' % size)
+            request.setHeader('content-length', '0')
             return ''
 
-        request.setHeader('content-length', str(size))
-        
-        producer = NoRangeStaticProducer(request, contentFile)
+        if not ranges:
+            parts = [(offset, size)]
+            request.setHeader('content-length', str(size))
+        elif len(ranges) == 1:
+            (start, end), = ranges
+            parts = [(offset + start, end - start + 1)]
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader('content-range',
+                              'bytes %d-%d/%d' % (start, end, size))
+            request.setHeader('content-length', str(end - start + 1))
+        else:
+            boundary = '%x%x' % (random.getrandbits(64),
+                                 random.getrandbits(64))
+            parts = list()
+            length = 0
+            for start, end in ranges:
+                header = ('\r\n--%s\r\n'
+                          'Content-Type: application/octet-stream\r\n'
+                          'Content-Range: bytes %d-%d/%d\r\n\r\n'
+                          % (boundary, start, end, size))
+                parts.append((header, offset + start, end - start + 1))
+                length += len(header) + end - start + 1
+            trailer = '\r\n--%s--\r\n' % boundary
+            request.setResponseCode(http.PARTIAL_CONTENT)
+            request.setHeader('content-type',
+                              'multipart/byteranges; boundary=%s' % boundary)
+            request.setHeader('content-length', str(length + len(trailer)))
+
         if request.method == 'HEAD':
             return ''
 
+        try:
+            contentFile = open(abspath, 'rb')
+        except (OSError, IOError), e:
+            request.setResponseCode(500)
+            request.setHeader('content-length', '0')
+            return ''
+
+        if ranges and len(ranges) > 1:
+            producer = MultipleRangeProducer(request, contentFile, parts,
+                                             trailer)
+        else:
+            if self.useSendfile and canSendfile(request):
+                producerFactory = SendfileProducer
+            else:
+                producerFactory = ChunkProducer
+            (partOffset, partSize), = parts
+            producer = producerFactory(request, contentFile, partOffset,
+                                       partSize)
         producer.start()
         # and make sure the connection doesn't get closed
         return server.NOT_DONE_YET
 
+    def checkIfRange(self, request, etag):
+        """
+        Check the I{If-Range} header of the request.
+
+        @return: C{True} if a I{Range} header in the request should be
+            honoured; that is, if there is no I{If-Range} header or it
+            matches the entity tag of the chunk.
+        """
+        ifRange = request.getHeader('if-range')
+        if ifRange is None:
+            return True
+        return ifRange.strip() == etag
+
     render_HEAD = render_GET
 
     def render_PUT(self, request):
         """
         Render a PUT request.
         """
-        pumpDeferred = store.pump(name, request.content)
+        request.content.seek(0)
+        if self.origin and hasattr(self.store, 'isProtected'):
+            # Stores with a quota keep the chunks of this node.
+            pumpDeferred = self.store.pump(self.chunkName, request.content,
+                                           origin=True)
+        else:
+            pumpDeferred = self.store.pump(self.chunkName, request.content)
         request.setResponseCode(http.CREATED)
         pumpDeferred.addCallback(lambda x: request.finish())
-        return server.NOT_YET_DONE
+        return server.NOT_DONE_YET
 
 
 class StoreResource(Resource):
@@ -93,10 +399,22 @@ class StoreResource(Resource):
 
     @ivar store: L{IStore} provider that acts as backing
     @type store: instance that provides L{IStore}
+
+    @ivar useSendfile: C{True} if chunks should be served with
+        C{sendfile} when the platform and transport allow it.
+    @type useSendfile: C{bool}
+
+    @ivar origin: C{True} if the resource is only reachable by local
+        applications, so that chunks put through it are chunks this
+        node is the origin of and are protected from eviction.
+    @type origin: C{bool}
     """
 
-    def __init__(self, store):
+    def __init__(self, store, useSendfile=True, origin=False):
+        Resource.__init__(self)
         self.store = store
+        self.useSendfile = useSendfile
+        self.origin = origin
 
     def getChild(self, chunkName, request):
         """
@@ -105,11 +423,11 @@ class StoreResource(Resource):
         if request.method == 'PUT':
             if self.store.hasChunk(chunkName):
                 return ConflictResource()
-            return ChunkResource(self.store, chunkName)
+            return ChunkResource(self.store, chunkName, origin=self.origin)
         elif request.method in ('GET', 'HEAD'):
             if not self.store.hasChunk(chunkName):
                 return NoResource()
-            return ChunkResource(self.store, chunkName)
+            return ChunkResource(self.store, chunkName, self.useSendfile)
         
 
 
@@ -1,56 +1,70 @@
 #
 
 from twisted.internet.task import coiterate
+from twisted.internet.threads import deferToThreadPool
 from twisted.internet import defer
+from twisted.python.threadpool import ThreadPool
+from twisted.python import log, failure
 from twisted.python.filepath import FilePath
 from distfs.error import NoSuchChunkError
+from distfs.index import ChunkIndex
+from distfs import hashing
 from distfs import idistfs
 from zope.interface import implements
 
-import hashlib
 import errno
+import time
+import os
 
 """Storage for chunks of data.
 """
 
 
-def publishChunks(store, publisher):
+class PumpIterator(object):
     """
-    Iterate through all chunks in the C{store} and publish
-    them to the overlay using the given publisher.
-
-    @type store: L{IStore}
-    @type publisher: L{IPublisher}
+    Copies a file in blocks of C{readSize} bytes, hashing the data
+    with C{algorithm} unless that is C{None}.
 
-    @return: a L{Deferred} that will be called when the
-        all chunks in the store has been published.
-    @rtype: L{Deferred}
+    Files that support C{readinto} are read into a single buffer that
+    is reused for every block, rather than into a new string per
+    block.
     """
-    ds = list()
-    for chunkName in store.iterChunks():
-        ds.append(publisher.publish(chunkName))
-    return defer.DeferredList(ds)
-
-
-class PumpIterator(object):
 
     readSize = (128*1024 - 32)
 
-    def __init__(self, toFile, fromFile):
+    def __init__(self, toFile, fromFile, algorithm='sha1', readSize=None):
         self.toFile = toFile
         self.fromFile = fromFile
-        self.hash = hashlib.sha()
+        self.algorithm = algorithm
+        if readSize is not None:
+            self.readSize = readSize
+        assert self.readSize > 0, "read size must be positive"
+        self.hash = None
+        if algorithm is not None:
+            self.hash = hashing.newHash(algorithm)
+        self.buffer = None
+        if hasattr(fromFile, 'readinto'):
+            self.buffer = bytearray(self.readSize)
+            self.view = memoryview(self.buffer)
+        self.written = 0
 
     def next(self):
         """
         Copy one chunk.
         """
-        data = self.fromFile.read(self.readSize)
-        if not data:
+        if self.buffer is not None:
+            count = self.fromFile.readinto(self.buffer)
+            data = self.view[:count]
+        else:
+            data = self.fromFile.read(self.readSize)
+            count = len(data)
+        if not count:
             self.toFile.close()
             raise StopIteration
-        self.hash.update(data)
+        if self.hash is not None:
+            self.hash.update(data)
         self.toFile.write(data)
+        self.written += count
 
     def digest(self):
         """
@@ -58,22 +72,470 @@ class PumpIterator(object):
 
         @rtype: C{str}
         """
-        return self.hash.hexdigest()
+        return hashing.formatDigest(self.algorithm, self.hash.hexdigest())
+
+
+class ThreadPump(object):
+    """
+    Runs L{PumpIterator}s to completion in a bounded pool of worker
+    threads, so that reading, hashing and writing chunks does not
+    hold up the reactor.  The hash functions release the GIL while
+    they work on a block, so pumps in different threads can hash at
+    the same time.
+
+    With C{maxThreads} set to C{0} the iterators are run on the
+    reactor thread with L{coiterate} instead.
+
+    The pool is started when it is first used and stopped when the
+    reactor shuts down.
+    """
+
+    def __init__(self, maxThreads=4, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.maxThreads = maxThreads
+        self.pool = None
+
+    def _pump(self, iterator):
+        try:
+            while True:
+                iterator.next()
+        except StopIteration:
+            pass
+        return iterator
+
+    def _getPool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(0, self.maxThreads, 'distfs-pump')
+            self.pool.start()
+            self.reactor.addSystemEventTrigger('during', 'shutdown',
+                                               self.pool.stop)
+        return self.pool
+
+    def run(self, iterator):
+        """
+        Run C{iterator} until it is exhausted.
+
+        @return: a L{Deferred} that will be called with the iterator
+            on the reactor thread.
+        """
+        if not self.maxThreads:
+            return coiterate(iterator)
+        return deferToThreadPool(self.reactor, self._getPool(), self._pump,
+                                 iterator)
+
+    def call(self, function, *args):
+        """
+        Call C{function} with C{args} in a worker thread.
+
+        @return: a L{Deferred} that will be called with the result on
+            the reactor thread.
+        """
+        if not self.maxThreads:
+            return defer.maybeDeferred(function, *args)
+        return deferToThreadPool(self.reactor, self._getPool(), function,
+                                 *args)
+
+
+fdatasync = getattr(os, 'fdatasync', os.fsync)
 
+def syncPath(path):
+    """
+    Make the content of a file, or the entries of a directory, durable.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fdatasync(fd)
+    finally:
+        os.close(fd)
 
-class StoreFile(object):
 
-    def __init__(self, store, chunkName):
-        self.pumpPath = store.dir.child('%s.pump' % chunkName)
-        self.file = open(self.pumpPath.path, 'w')
+def syncPaths(paths):
+    """
+    Make the given files and directories durable.
+
+    Only the given paths are synced, rather than the whole file system
+    with C{syncfs}, which would also have to wait for the writes of
+    every other process on it.
+    """
+    for path in paths:
+        syncPath(path)
+
+
+class GroupCommitter(object):
+    """
+    Makes chunks of a L{FileSystemStore} durable and moves them into
+    place, in batches.
+
+    The data files of a batch are synced to disk in parallel in the
+    worker threads of the store.  The hash files are then written, the
+    names and digests of the chunks are appended to the journal, the
+    temporary files are renamed to their final names, the directories
+    are synced and all chunks are added to the index in a single
+    transaction.  Chunks that are committed while a batch is being
+    synced wait for the next batch, so the more chunks are committed
+    at the same time, the more of them share the journal write, the
+    directory syncs and the index transaction.
+
+    Should the node crash before the index transaction, the journal
+    tells L{FileSystemStore.recover} which chunks to look at and what
+    their digests are, so the hash files do not have to be synced.
+    The journal is removed after a batch has been indexed, unless an
+    earlier batch failed; its entries are then kept, and later batches
+    are appended to them, until the store is opened again.
+
+    @ivar unrecovered: C{True} if a batch has failed since the store
+        was opened, so the journal must be kept.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.pending = list()
+        self.running = False
+        self.unrecovered = False
+
+    def commit(self, chunkName, temporaryPath, size, digest):
+        """
+        Commit a fully written chunk.
+
+        @return: a L{Deferred} that will be called when the chunk is
+            available in the store.
+        """
+        commitDeferred = defer.Deferred()
+        self.pending.append((chunkName, temporaryPath, size, digest,
+                             commitDeferred))
+        if not self.running:
+            self._flush()
+        return commitDeferred
+
+    def _flush(self):
+        batch, self.pending = self.pending, list()
+        self.running = True
+        syncs = [self.store.pumper.call(syncPath, temporaryPath.path)
+                 for (chunkName, temporaryPath, size, digest, d) in batch]
+        syncDeferred = defer.DeferredList(syncs, consumeErrors=True)
+        syncDeferred.addCallback(self._dataSynced, batch)
+        syncDeferred.addBoth(self._synced, batch)
+
+    def _dataSynced(self, syncs, batch):
+        results = [(not success and result or None)
+                   for (success, result) in syncs]
+        return self.store.pumper.call(self._sync, batch, results)
+
+    def _sync(self, batch, results):
+        """
+        Journal and rename the files of a batch whose data files have
+        been synced.  Runs in a worker thread.
+
+        @param results: C{None} for every chunk whose data file was
+            synced, a L{failure.Failure} for every chunk whose was not.
+        @return: a C{list} with C{None} for every chunk that was moved
+            into place and a L{failure.Failure} for every chunk that was
+            not.
+        """
+        store = self.store
+        for i, (chunkName, temporaryPath, size, digest, d) in enumerate(batch):
+            if results[i] is not None:
+                continue
+            try:
+                store.chunkPath(chunkName, 'hash').setContent(digest)
+            except:
+                results[i] = failure.Failure()
+
+        journal = store.journalPath.open('a')
+        try:
+            for (chunkName, temporaryPath, size, digest, d), result in zip(
+                batch, results):
+                if result is None:
+                    journal.write('%s %s\n' % (chunkName, digest))
+            journal.flush()
+            fdatasync(journal.fileno())
+        finally:
+            journal.close()
+
+        directories = set()
+        for i, (chunkName, temporaryPath, size, digest, d) in enumerate(batch):
+            if results[i] is not None:
+                continue
+            try:
+                temporaryPath.moveTo(store.chunkPath(chunkName, 'data'))
+                directories.add(store.chunkDirectory(chunkName).path)
+            except:
+                results[i] = failure.Failure()
+        syncPaths(directories)
+        return results
+
+    def _synced(self, results, batch):
+        try:
+            if not isinstance(results, failure.Failure):
+                now = time.time()
+                self.store.index.addMany(
+                    [(chunkName, size, digest, now)
+                     for (chunkName, temporaryPath, size, digest, d), result
+                     in zip(batch, results) if result is None])
+                if not self.unrecovered:
+                    self.store.journalPath.remove()
+        except:
+            results = failure.Failure()
+        if isinstance(results, failure.Failure):
+            # The journal, if it was written, is left for recovery.
+            self.unrecovered = True
+            results = [results] * len(batch)
+
+        self.running = False
+        if self.pending:
+            self._flush()
+        for (chunkName, temporaryPath, size, digest, d), result in zip(
+            batch, results):
+            if result is None:
+                self.store.notifyAdded(chunkName)
+                d.callback(None)
+            else:
+                d.errback(result)
+
+
+class ObservableStore(object):
+    """
+    Base class for stores that tell L{IStoreObserver}s about chunks
+    that are added and removed.
+
+    @ivar observers: the observers of the store.
+    """
+
+    def __init__(self):
+        self.observers = list()
+
+    def addObserver(self, observer):
+        self.observers.append(observer)
+
+    def removeObserver(self, observer):
+        self.observers.remove(observer)
+
+    def notifyAdded(self, chunkName):
+        for observer in list(self.observers):
+            observer.chunkAdded(chunkName)
+
+    def notifyRemoved(self, chunkName):
+        for observer in list(self.observers):
+            observer.chunkRemoved(chunkName)
+
+
+readSizes = (64*1024, 128*1024, 256*1024, 512*1024, 1024*1024,
+             4*1024*1024)
+
+
+def _dropCache(fileObject):
+    """
+    Ask the kernel to drop the cached pages of a file, so that it is
+    read from the device again.
+
+    @return: C{True} if the pages were dropped.
+    """
+    fadvise = getattr(os, 'posix_fadvise', None)
+    if fadvise is None:
+        return False
+    fileObject.flush()
+    fdatasync(fileObject.fileno())
+    fadvise(fileObject.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return True
+
+
+def tuneReadSize(directory, algorithm='sha1', sampleSize=None,
+                 candidates=readSizes):
+    """
+    Find the read size that pumps data fastest on the device that
+    holds C{directory}, by timing a pump of a sample file with each of
+    the C{candidates}.
+
+    The sample is dropped from the page cache before every pump, so
+    that it is read from the device.  Where that is not possible the
+    sample is read from the cache, and the timings only tell which
+    read size copies and hashes fastest; a smaller sample is then
+    written by default, since the device does not take part anyway.
+
+    @param sampleSize: size of the sample file in bytes; 64 MiB, or
+        8 MiB if the cache cannot be dropped, by default.
+    @return: the best read size.
+    """
+    samplePath = os.path.join(directory, 'tune.sample')
+    copyPath = os.path.join(directory, 'tune.pump')
+    if sampleSize is None:
+        sampleSize = 64*1024*1024
+        if not hasattr(os, 'posix_fadvise'):
+            sampleSize = 8*1024*1024
+    block = os.urandom(1024 * 1024)
+    sampleFile = open(samplePath, 'wb')
+    try:
+        for i in xrange(sampleSize // len(block)):
+            sampleFile.write(block)
+    finally:
+        sampleFile.close()
+
+    timings = list()
+    try:
+        for readSize in candidates:
+            fromFile = open(samplePath, 'rb')
+            _dropCache(fromFile)
+            iterator = PumpIterator(open(copyPath, 'wb'), fromFile,
+                                    algorithm, readSize)
+            started = time.time()
+            try:
+                while True:
+                    iterator.next()
+            except StopIteration:
+                pass
+            fromFile.close()
+            timings.append((time.time() - started, readSize))
+    finally:
+        for path in (samplePath, copyPath):
+            if os.path.exists(path):
+                os.remove(path)
+    return min(timings)[1]
+
+
+class HashingFile(object):
+    """
+    Base class for the file-like objects that chunks are written
+    through.
+
+    The digest of the data is computed while it is written, so that
+    it is known as soon as the last byte has arrived and the chunk
+    never has to be read back just to be verified.  Data written out
+    of order with C{writeAt} is hashed as soon as the data in front
+    of it has been written; only data that overwrites bytes that have
+    already been hashed makes it necessary to hash the whole file
+    again.
+
+    Subclasses set C{file} to an open file and C{algorithm} to the
+    name of the hash algorithm.
+
+    @ivar written: number of bytes in the file, including any data
+        that was kept from an earlier attempt when resuming.
+    @ivar hash: hash of the first C{hashed} bytes, or C{None} if it
+        has to be computed from the file.
+    @ivar extents: a C{dict} that maps the offsets of data written
+        beyond C{hashed} to the offsets where that data ends.
+    """
+
+    def _reset(self):
+        self.hash = hashing.newHash(self.algorithm)
+        self.hashed = 0
+        self.extents = dict()
+
+    def _rehash(self):
+        """
+        Hash the data in the file.
+        """
+        self._reset()
         self.written = 0
-        self.hash = hashlib.sha()
-        self.chunkName = chunkName
+        self.file.seek(0)
+        while True:
+            data = self.file.read(self.store.readSize)
+            if not data:
+                break
+            self.hash.update(data)
+            self.written += len(data)
+        self.hashed = self.written
+
+    def _advance(self):
+        """
+        Hash the data that was written out of order and is no longer
+        preceded by a gap.
+        """
+        while self.hashed in self.extents:
+            end = self.extents.pop(self.hashed)
+            self.file.seek(self.hashed)
+            while self.hashed < end:
+                data = self.file.read(min(self.store.readSize,
+                                          end - self.hashed))
+                self.hash.update(data)
+                self.hashed += len(data)
 
     def write(self, bytes):
-        self.written += len(bytes)
+        self.writeAt(self.written, bytes)
+
+    def writeAt(self, offset, bytes):
+        """
+        Write data at the given offset of the file.
+        """
+        self.file.seek(offset)
         self.file.write(bytes)
-        self.hash.update(data)
+        end = offset + len(bytes)
+        self.written = max(self.written, end)
+        if self.hash is None:
+            return
+        if offset == self.hashed:
+            self.hash.update(bytes)
+            self.hashed = end
+            self._advance()
+        elif offset > self.hashed:
+            self.extents[offset] = max(self.extents.get(offset, 0), end)
+        else:
+            self.hash = None
+
+    def digest(self):
+        """
+        Return hash digest of the data written so far.
+
+        @rtype: C{str}
+        """
+        if self.hash is None or self.hashed != self.written:
+            self._rehash()
+        return hashing.formatDigest(self.algorithm, self.hash.hexdigest())
+
+    def useAlgorithm(self, algorithm):
+        """
+        Hash the data with C{algorithm} instead, for instance because
+        the chunk is known by a digest of that algorithm.  Data that
+        has already been written is hashed again.
+        """
+        if algorithm == self.algorithm:
+            return
+        hashing.newHash(algorithm)
+        self.algorithm = algorithm
+        self._rehash()
+
+    def truncate(self, size=0):
+        """
+        Throw away all data beyond C{size} bytes.
+        """
+        self.file.truncate(size)
+        if size:
+            self._rehash()
+        else:
+            self.written = 0
+            self._reset()
+
+
+class StoreFile(HashingFile):
+    """
+    File-like object returned by L{FileSystemStore.store}.
+    """
+
+    def __init__(self, store, chunkName, resume=False):
+        self.store = store
+        self.pumpPath = store.chunkPath(chunkName, 'pump')
+        store.prepareChunk(chunkName)
+        self.algorithm = hashing.chunkAlgorithm(chunkName, store.algorithm)
+        self.written = 0
+        self._reset()
+        self.chunkName = chunkName
+        if resume and self.pumpPath.exists():
+            self.file = open(self.pumpPath.path, 'r+b')
+            # The hash state of the earlier attempt is lost, so the
+            # data kept from it has to be hashed again.
+            self._rehash()
+        else:
+            self.file = open(self.pumpPath.path, 'w+b')
+
+    def suspend(self):
+        """
+        Close the file without making the chunk available.  The data
+        written so far is kept so that it can be resumed by passing
+        C{resume=True} to L{FileSystemStore.store}.
+        """
+        self.file.close()
 
     def close(self):
         """
@@ -81,48 +543,175 @@ class StoreFile(object):
         written to the chunk.
 
         """
+        digest = self.digest()
+        self.file.close()
         if not self.written:
             self.pumpPath.remove()
-            return
+            return defer.succeed(None)
 
-        destinationPath = self.store.dir.child('%s.data' % self.chunkName)
-        self.pumpPath.moveTo(destinationPath)
-        
-        # Write hash digest to a separate file so that we may get hold
-        # of it later.
-        digestPath = self.store.dir.child('%s.hash' % self.chunkName)
-        digestPath.setContent(self.hash.hexdigest())
+        return self.store.commitChunk(self.chunkName, self.pumpPath,
+                                      self.written, digest)
 
 
-class FileSystemStore(object):
+class FileSystemStore(ObservableStore):
     """
     Chunk store that stores chunks in a directory on the local file
     system.
 
+    Chunks are spread out over a tree of fan-out directories named
+    after the leading characters of the chunk name, so that no single
+    directory grows too large.  With the default settings the chunk
+    C{abcdef} is stored as C{ab/cd/abcdef.data} and
+    C{ab/cd/abcdef.hash}.
+
     @ivar computes: a C{dict} that maps chunk ids to L{Deferreds} for
         hash computes that is currently taking place.
 
+    @ivar index: L{ChunkIndex} that holds size and digest of every
+        chunk in the store, so that lookups do not have to touch the
+        file system.  It is persisted in C{index.db} in the top
+        directory of the store.
+
+    @ivar depth: number of fan-out directory levels.
+    @ivar width: number of chunk name characters used to name each
+        fan-out directory.
+    @ivar algorithm: hash algorithm that new chunks are hashed with,
+        unless they are named after a digest of another algorithm;
+        see L{distfs.hashing}.
+    @ivar pumper: L{ThreadPump} that runs L{pump}s.
+    @ivar readSize: block size used when pumping chunks.
+    @ivar committer: L{GroupCommitter} that moves new chunks into
+        place.
+    @ivar journalPath: the journal of the L{GroupCommitter}.
+    @ivar observers: L{IStoreObserver}s that are told about chunks
+        that are committed or removed.
+    @cvar pumpThreads: number of threads that pump at the same time.
+    @cvar pumpExpiry: age in seconds after which C{.pump} files that
+        were left behind are removed by L{removeStalePumps}.
     """
     implements(idistfs.IStore)
 
-    def __init__(self, dir):
+    depth = 2
+    width = 2
+    algorithm = hashing.defaultAlgorithm
+    readSize = PumpIterator.readSize
+    pumpThreads = 4
+    pumpExpiry = 24 * 60 * 60
+
+    def __init__(self, dir, depth=None, width=None, algorithm=None,
+                 readSize=None):
+        ObservableStore.__init__(self)
         self.dir = FilePath(dir)
         self.computes = dict()
+        if depth is not None:
+            self.depth = depth
+        if width is not None:
+            self.width = width
+        if readSize is not None:
+            self.readSize = readSize
+        if algorithm is not None:
+            hashing.newHash(algorithm)
+            self.algorithm = algorithm
+        self.pumper = ThreadPump(self.pumpThreads)
         try:
             self.dir.createDirectory()
         except OSError, e:
-            if e.errno == errno.EEXIST:
+            if e.errno != errno.EEXIST:
+                raise
+        self.index = ChunkIndex(self.dir.child('index.db').path)
+        self.committer = GroupCommitter(self)
+        self.journalPath = self.dir.child('commit.journal')
+        if self.index.created:
+            self.reindex()
+        elif self.journalPath.exists():
+            self.recover()
+
+    def chunkDirectory(self, chunkName):
+        """
+        Return the fan-out directory that holds the specified chunk.
+
+        Chunk names that are too short to fill all levels are padded
+        with underscores.
+
+        @rtype: L{FilePath}
+        """
+        path = self.dir
+        for level in range(self.depth):
+            start = level * self.width
+            prefix = chunkName[start:start + self.width]
+            path = path.child(prefix.ljust(self.width, '_'))
+        return path
+
+    def chunkPath(self, chunkName, extension):
+        """
+        Return path to a file that belongs to the specified chunk.
+
+        @param extension: C{'data'}, C{'hash'} or C{'pump'}.
+        @rtype: L{FilePath}
+        """
+        return self.chunkDirectory(chunkName).child(
+            '%s.%s' % (chunkName, extension))
+
+    def prepareChunk(self, chunkName):
+        """
+        Make sure that the fan-out directory for the specified chunk
+        exists so that files can be created in it.
+        """
+        try:
+            os.makedirs(self.chunkDirectory(chunkName).path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _iterDirectories(self, path, level):
+        """
+        Iterate through all leaf fan-out directories below C{path}.
+        """
+        if level == self.depth:
+            yield path.path
+            return
+        try:
+            names = os.listdir(path.path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
                 return
             raise
+        for name in sorted(names):
+            if len(name) != self.width:
+                continue
+            child = path.child(name)
+            if child.isdir():
+                for directory in self._iterDirectories(child, level + 1):
+                    yield directory
+
+    def scanChunks(self):
+        """
+        Iterate through all chunks that are available on disk,
+        regardless of what is in the index.
+        """
+        for directory in self._iterDirectories(self.dir, 0):
+            names = set(os.listdir(directory))
+            for name in names:
+                if name.endswith('.hash') and ('%s.data' % name[:-5]) in names:
+                    yield name[:-5]
+
+    def reindex(self):
+        """
+        Rebuild the index from the content of the store.
+        """
+        def entries():
+            for chunkName in self.scanChunks():
+                dataPath = self.chunkPath(chunkName, 'data')
+                hashPath = self.chunkPath(chunkName, 'hash')
+                yield (chunkName, dataPath.getsize(), hashPath.getContent(),
+                       dataPath.getModificationTime())
+        self.index.replace(entries())
 
     def iterChunks(self):
         """
         Iterate through all available chunks.
         """
-        names = self.dir.listdir()
-        for name in names:
-            if name.endswith('.hash') and ('%s.data' % name[:-5]) in names:
-                yield name[:-5]
+        return iter(self.index)
 
     def hasChunk(self, chunkName):
         """
@@ -131,9 +720,7 @@ class FileSystemStore(object):
         @return: a C{bool} that is C{True} if the chunk is available
         locally.
         """
-        dataPath = self.dir.child('%s.data' % chunkName)
-        hashPath = self.dir.child('%s.hash' % chunkName)
-        return dataPath.exists() and hashPath.exists()
+        return chunkName in self.index
 
     def __contains__(self, chunkName):
         return self.hasChunk(chunkName)
@@ -144,13 +731,74 @@ class FileSystemStore(object):
 
         Renames the chunk and writes a new hash file.
         """
-        destinationPath = self.dir.child('%s.data' % chunkName)
-        temporaryPath.moveTo(destinationPath)
-        
-        # Write hash digest to a separate file so that we may get hold
-        # of it later.
-        digestPath = self.dir.child('%s.hash' % chunkName)
-        digestPath.setContent(iterator.digest())
+        return self.commitChunk(chunkName, temporaryPath, iterator.written,
+                                iterator.digest())
+
+    def commitChunk(self, chunkName, temporaryPath, size, digest):
+        """
+        Make a fully written chunk available in the store.
+
+        @return: a L{Deferred} that will be called when the chunk has
+            been made durable, moved into place and recorded in the
+            index; see L{GroupCommitter}.
+        """
+        return self.committer.commit(chunkName, temporaryPath, size, digest)
+
+    def recover(self):
+        """
+        Finish or throw away the commits that were in progress when
+        the node stopped, as listed in the journal.
+
+        The hash files of the chunks may not have made it to disk, so
+        they are rewritten from the digests in the journal.
+        """
+        for line in self.journalPath.getContent().splitlines():
+            fields = line.split()
+            if len(fields) != 2 or not hashing.digestAlgorithm(fields[1]):
+                # torn by the crash; the chunk was never moved into place
+                continue
+            chunkName, digest = fields
+            dataPath = self.chunkPath(chunkName, 'data')
+            hashPath = self.chunkPath(chunkName, 'hash')
+            if dataPath.exists():
+                hashPath.setContent(digest)
+                self.index.add(chunkName, dataPath.getsize(), digest,
+                               dataPath.getModificationTime())
+            elif hashPath.exists() and not self.chunkPath(chunkName,
+                                                           'pump').exists():
+                hashPath.remove()
+        self.journalPath.remove()
+
+    def removeStalePumps(self):
+        """
+        Remove C{.pump} files that have not been written to for
+        C{pumpExpiry} seconds, such as those of downloads that were
+        given up.  The store is walked a directory at a time without
+        blocking the reactor.
+
+        @return: a L{Deferred} that will be called with the number of
+            removed files.
+        """
+        removed = list()
+
+        def remove():
+            expires = time.time() - self.pumpExpiry
+            for directory in self._iterDirectories(self.dir, 0):
+                for name in os.listdir(directory):
+                    if not name.endswith('.pump'):
+                        continue
+                    path = os.path.join(directory, name)
+                    try:
+                        if os.path.getmtime(path) < expires:
+                            os.remove(path)
+                            removed.append(path)
+                    except OSError, e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                yield None
+
+        removeDeferred = coiterate(remove())
+        return removeDeferred.addCallback(lambda ignore: len(removed))
 
     def pump(self, chunkName, fromFile):
         """
@@ -160,28 +808,36 @@ class FileSystemStore(object):
         @return: a Deferred that will be called when the file has been
             transfered.
         """
-        pumpPath = self.dir.child('%s.pump' % chunkName)
+        pumpPath = self.chunkPath(chunkName, 'pump')
 
         try:
-            iterator = PumpIterator(pumpPath.open('w'), fromFile)
+            self.prepareChunk(chunkName)
+            iterator = PumpIterator(pumpPath.open('w'), fromFile,
+                                    hashing.chunkAlgorithm(chunkName,
+                                                           self.algorithm),
+                                    self.readSize)
         except OSError, e:
             return defer.fail(e)
 
-        doneDeferred = coiterate(iterator).whenDone()
+        doneDeferred = self.pumper.run(iterator)
         
         # We use the same deferred as the cbPump callback is attached
         # to so that we get errors that it raises.
         return doneDeferred.addCallback(self.cbPump, chunkName, pumpPath)
 
-    def store(self, chunkName):
+    def store(self, chunkName, resume=False):
         """
         Returns a file-like object that is used to write content to
         the chunk.
 
-        The chunk is not available until the file-like object has
-        been closed by invoking the C{close} method.
+        The chunk is not available until the L{Deferred} returned by
+        the C{close} method of the file-like object has been called.
+
+        @param resume: if C{True}, data left behind by an earlier
+            suspended file for the same chunk is kept and new data is
+            appended to it.
         """
-        return StoreFile(self, chunkName)
+        return StoreFile(self, chunkName, resume)
 
     def query(self, chunkName):
         """
@@ -190,11 +846,97 @@ class FileSystemStore(object):
         @return: a C{tuple} with an absolute path to the chunk, the
             chunk size and its hash digest.
         """
-        dataPath = self.dir.child('%s.data' % chunkName)
-        hashPath = self.dir.child('%s.hash' % chunkName)
-        if dataPath.exists() and hashPath.exists():
-            return (dataPath.path, dataPath.getsize(),
-                    hashPath.open().read())
+        entry = self.index.get(chunkName)
+        if entry is None:
+            raise NoSuchChunkError(chunkName)
+        size, digest, mtime = entry
+        return (self.chunkPath(chunkName, 'data').path, size, digest)
+
+    def locate(self, chunkName):
+        """
+        Return a C{tuple} with the path to the file that holds the
+        chunk, the offset of the chunk within it and the chunk size.
+        """
+        path, size, digest = self.query(chunkName)
+        return (path, 0, size)
+
+    def remove(self, chunkName):
+        """
+        Remove the specified chunk from the store.
+        """
+        if chunkName not in self.index:
+            raise NoSuchChunkError(chunkName)
+        self.index.remove(chunkName)
+        for extension in ('hash', 'data'):
+            try:
+                self.chunkPath(chunkName, extension).remove()
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self.notifyRemoved(chunkName)
+
+
+storeFormats = ('fs', 'pack')
 
-        raise NoSuchChunkError(chunkName)
 
+def openStore(dir, format='fs', algorithm=None, readSize=None):
+    """
+    Open the chunk store in the specified directory.
+
+    @param format: C{'fs'} for a L{FileSystemStore} that keeps every
+        chunk in a file of its own, or C{'pack'} for a L{PackStore}
+        that appends chunks to large segment files.
+    @param algorithm: hash algorithm for new chunks, or C{None} for
+        the default.
+    @param readSize: block size for pumping chunks, C{None} for the
+        default or C{'auto'} to measure which size is fastest with
+        L{tuneReadSize}.
+    @rtype: L{IStore} provider
+    """
+    if format == 'fs':
+        store = FileSystemStore(dir, algorithm=algorithm)
+    elif format == 'pack':
+        from distfs.pack import PackStore
+        store = PackStore(dir, algorithm)
+    else:
+        raise ValueError("unknown store format: %r" % (format,))
+    if readSize == 'auto':
+        readSize = tuneReadSize(store.dir.path, store.algorithm)
+        log.msg("pumping chunks in blocks of %d bytes" % readSize)
+    if readSize is not None:
+        store.readSize = readSize
+    return store
+
+
+def migrateFlatStore(store):
+    """
+    Move chunks that are stored directly in the top directory of
+    C{store} (the old flat layout) into their fan-out directories.
+
+    Left-over C{.pump} files from interrupted transfers are removed.
+
+    @type store: L{FileSystemStore}
+    @return: number of migrated chunks.
+    @rtype: C{int}
+    """
+    names = set(store.dir.listdir())
+    migrated = 0
+    for name in names:
+        if name.endswith('.pump'):
+            store.dir.child(name).remove()
+            continue
+        if not name.endswith('.hash'):
+            continue
+        chunkName = name[:-5]
+        dataName = '%s.data' % chunkName
+        if dataName not in names:
+            continue
+        store.prepareChunk(chunkName)
+        # Move the data file before the hash file so that the chunk
+        # never shows up in the new location without its data.
+        store.dir.child(dataName).moveTo(store.chunkPath(chunkName, 'data'))
+        store.dir.child(name).moveTo(store.chunkPath(chunkName, 'hash'))
+        migrated += 1
+    if migrated:
+        store.reindex()
+    return migrated
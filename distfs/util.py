@@ -1,47 +1,138 @@
 from twisted.internet import defer
+from collections import deque
+import itertools
+import hashlib
+import heapq
+import errno
 import os
 
 
+FOREGROUND = 0
+BACKGROUND = 1
+REPLICATION = 2
+
+PRIORITIES = (FOREGROUND, BACKGROUND, REPLICATION)
+
+
 class ParallelQueue(object):
     """
+    Queue that runs at most C{maxProcessing} tasks at a time.
+
+    Items are added with a priority class; a task is never started
+    while an item of a more urgent class is waiting.  Within a class
+    the clients that have items waiting take turns, so that one
+    client queueing many items does not hold up the others.  Each
+    client's items are started in the order of the C{order} hints
+    they were added with, and in the order they were added among
+    equal hints.
+
+    @ivar classes: a C{dict} that maps each priority class to a
+        C{deque} of the clients that have items waiting in it, in the
+        order they take turns.
+    @ivar waiting: a C{dict} that maps C{(priority, client)} to a heap
+        of C{(order, sequence, entry)} tuples, where the entries are
+        C{[item, completeDeferred]} lists.
+    @ivar entries: a C{dict} that maps waiting items to their entries.
     """
     maxProcessing = 8
     
     def __init__(self, start):
         self.start = start
-        self.queue = list()
+        self.classes = dict((priority, deque()) for priority in PRIORITIES)
+        self.waiting = dict()
+        self.entries = dict()
         self.processing = 0
+        self.sequence = itertools.count()
         
-    def done(self, result, item):
+    def __len__(self):
+        return len(self.entries)
+
+    def done(self, result):
         self.processing -= 1
         self.schdule()
         return result
 
+    def next(self):
+        """
+        Remove and return the entry that should be started next, or
+        C{None} if nothing is waiting.
+        """
+        for priority in PRIORITIES:
+            clients = self.classes[priority]
+            while clients:
+                client = clients.popleft()
+                entries = self.waiting[priority, client]
+                entry = heapq.heappop(entries)[2]
+                if not entries:
+                    del self.waiting[priority, client]
+                elif entry[0] is None:
+                    # A removed item does not use up the client's turn.
+                    clients.appendleft(client)
+                else:
+                    clients.append(client)
+                if entry[0] is not None:
+                    return entry
+        return None
+
     def schdule(self):
         """
         Iterate through the queue and schedule as many tasks as
         possible.
         """
-        while self.queue:
-            if self.processing >= self.maxProcessing:
-                # We have reached the maximum number of parallel
-                # tasks.
+        while self.processing < self.maxProcessing:
+            entry = self.next()
+            if entry is None:
                 break
 
-            item, completeDeferred = self.queue.pop(0)
+            item, completeDeferred = entry
+            del self.entries[item]
 
             self.processing += 1            
-            self.start(item).addBoth(self.done).chainDeferred(completeDeferred)
+            startDeferred = defer.maybeDeferred(self.start, item)
+            startDeferred.addBoth(self.done).chainDeferred(completeDeferred)
 
 
-    def add(self, item):
+    def add(self, item, priority=FOREGROUND, client=None, order=0):
         """
         Add an item to the queue.
 
         C{item} will be passed to the queue's C{start} function.
+
+        @param priority: one of L{FOREGROUND}, L{BACKGROUND} and
+            L{REPLICATION}, from most to least urgent.
+        @param client: the client that the item is added on behalf
+            of; clients take turns within a priority class.
+        @param order: ordering hint; among the items of a client in
+            the same priority class, those with the lowest hint are
+            started first.
+
+        @return: a L{Deferred} that will be called with the result of
+            the task.
         """
         completeDeferred = defer.Deferred()
-        self.queue.append((item, completeDeferred))
+        entry = [item, completeDeferred]
+        self.entries[item] = entry
+        key = (priority, client)
+        if key not in self.waiting:
+            self.waiting[key] = list()
+            self.classes[priority].append(client)
+        heapq.heappush(self.waiting[key],
+                       (order, self.sequence.next(), entry))
+        self.schdule()
+        return completeDeferred
+
+    def remove(self, item):
+        """
+        Remove an item that has not been started yet from the queue.
+
+        @return: C{True} if the item was waiting in the queue.
+        """
+        entry = self.entries.pop(item, None)
+        if entry is None:
+            return False
+        # The entry is skipped when its turn comes.
+        entry[0] = None
+        return True
 
 
 def shadigest(value):
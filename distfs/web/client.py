@@ -7,7 +7,7 @@ HTTP client.
 """
 
 import os, types
-from urlparse import urlunparse
+from urlparse import urlparse, urlunparse
 
 from twisted.python import log
 from twisted.web import http
@@ -28,6 +28,45 @@ from twisted.web.error import SchemeNotSupported
 from distfs.web._newclient import ResponseDone, Request, HTTP11ClientProtocol
 
 
+def _parse(url, defaultPort=None):
+    """
+    Split the given URL into the scheme, host, port, and path.
+
+    @type url: C{str}
+    @param url: An URL to parse.
+
+    @type defaultPort: C{int} or C{None}
+    @param defaultPort: An alternate value to use as the port if the URL does
+    not include one.
+
+    @return: A four-tuple of the scheme, host, port, and path of the URL.  All
+    of these are C{str} instances except for port, which is an C{int}.
+    """
+    url = url.strip()
+    parsed = urlparse(url)
+    scheme = parsed[0]
+    path = urlunparse(('', '') + parsed[2:])
+
+    if defaultPort is None:
+        if scheme == 'https':
+            defaultPort = 443
+        else:
+            defaultPort = 80
+
+    host, port = parsed[1], defaultPort
+    if ':' in host:
+        host, port = host.split(':')
+        try:
+            port = int(port)
+        except ValueError:
+            port = defaultPort
+
+    if path == '':
+        path = '/'
+
+    return scheme, host, port, path
+
+
 class Agent(object):
     """
     L{Agent} is a very basic HTTP client.  It supports I{HTTP} scheme URIs.  It
@@ -1,21 +1,44 @@
 from twisted.application.service import IServiceMaker, MultiService
-from twisted.application.internet import TCPServer
+from twisted.application.internet import TCPServer, TimerService
 from twisted.plugin import IPlugin
 from twisted.python import usage
 from twisted.web.server import Site
-from distfs.store import FileSystemStore
+from distfs.store import openStore
+from distfs.hashing import defaultAlgorithm
+from distfs.capacity import BoundedStore
+from distfs.scrub import Scrubber
 from distfs.server import StoreResource
+from distfs.script import checkStoreOptions
 from zope.interface import implements
 import os
 
 
 class Options(usage.Options):
+    optFlags = (
+        ('no-sendfile', None, 'Do not serve chunks with sendfile'),
+        )
+
     optParameters = (
         ('port', 'p', '8033', 'Listen port'),
         ('dir', 'd', '~/.distfs/store', 'Chunk storage directory'),
         ('introducer', 'i', None, 'Introducer address'),
+        ('store-format', 'f', 'fs',
+         'Chunk store format: fs (file per chunk) or pack (segment files)'),
+        ('hash', None, None,
+         'Hash algorithm for new chunks (default: %s)' % defaultAlgorithm),
+        ('read-size', None, None,
+         'Block size for pumping chunks, in bytes, or "auto" to measure'),
+        ('max-store-size', None, None,
+         'Store quota in bytes; K, M, G and T suffixes are allowed'),
+        ('max-chunks', None, None, 'Maximum number of chunks in the store'),
+        ('eviction', None, 'lru', 'Eviction policy: lru or lfu'),
+        ('scrub-rate', None, '4M',
+         'Bytes per second to re-verify stored chunks at; 0 disables'),
         )
 
+    def postOptions(self):
+        checkStoreOptions(self)
+
 
 class ServiceMaker(object):
     implements(IPlugin, IServiceMaker)
@@ -29,12 +52,31 @@ class ServiceMaker(object):
         """
         Build and return a service based on the given options.
         """
-        store = FileSystemStore(os.path.expanduser(config['dir']))
-        chunkFactory = Site(server.StoreResource(store))
+        store = openStore(os.path.expanduser(config['dir']),
+                          config['store-format'], config['hash'],
+                          config['read-size'])
+        bounded = (config['max-store-size'] is not None
+                   or config['max-chunks'] is not None)
+        if bounded:
+            store = BoundedStore(store, config['max-store-size'],
+                                 config['max-chunks'], config['eviction'])
+            store.evict()
+        chunkFactory = Site(StoreResource(store,
+                                         not config['no-sendfile']))
 
         multiService = MultiService()
-        multiService.addservice(TCPServer(int(config['port']),
+        multiService.addService(TCPServer(int(config['port']),
                                           chunkFactory))
+        if hasattr(store, 'compact'):
+            multiService.addService(TimerService(60*60, store.compact))
+        if hasattr(store, 'removeStalePumps'):
+            multiService.addService(TimerService(24*60*60,
+                                                 store.removeStalePumps))
+        if bounded:
+            multiService.addService(TimerService(60, store.flush))
+        if config['scrub-rate']:
+            multiService.addService(Scrubber(store,
+                                             rate=config['scrub-rate']))
         # FIXME: create dht node here.
         return multiService
 